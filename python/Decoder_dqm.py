@@ -1,4 +1,485 @@
+import os
+import sys
+import glob
+import time
 import struct
+import cPickle
+import binascii
+import multiprocessing
+from StringIO import StringIO
+from collections import namedtuple
+import numpy as np
+
+# one decoded event: position in the file (event count and byte offset of
+# the header), event number and size from the header, payload bytes and
+# the trailer fields, see Decoder.iterEvents
+Event = namedtuple("Event", ["index","offset","number","size","payload",
+                             "timestamp","roStatus","trigPhase","nStacked"])
+
+# event index stored next to binary data files, see Decoder.eventIndex
+eventIndexVersion = 1
+eventIndexType = np.dtype([("offset","<u8"),("event","<u4"),("size","<u4")])
+
+# per-event trailer columns kept by the decoder, see Decoder.setKeepEvents
+eventColumnsType = np.dtype([("timestamp","<u4"),("roStatus","u1"),("trigPhase","u1"),
+                             ("nStacked","u1"),("valid","?"),("size","<u4")])
+
+# decoded hits as written by Decoder.exportHits
+hitType = np.dtype([("event","<u4"),("roc","u1"),("column","u1"),("row","u1"),
+                    ("pulseheight","u1")])
+
+# clusters of adjacent hits as found by findClusters: size in hits, widths
+# in columns (x) and rows (y) and the summed pulse height
+clusterType = np.dtype([("event","<u4"),("roc","u1"),("size","<u2"),("widthX","u1"),
+                        ("widthY","u1"),("charge","<u4")])
+
+def decodeByteRange(args):
+    # worker of Decoder.decodeBinaryFileParallel: runs decodeByteRange of
+    # the given decoder and returns its summary together with the printout
+    decoder=args[0]
+    stdout=sys.stdout
+    sys.stdout=StringIO()
+    try:
+        summary=decoder.decodeByteRange(*args[1:])
+        printout=sys.stdout.getvalue()
+    finally:
+        sys.stdout=stdout
+        pass
+    return [summary,printout]
+
+
+def addCounts(keys,counts,newKeys,newCounts=None):
+    # add values (or values and their counts) to a sparse histogram kept
+    # as sorted keys and counts, returns the new keys and counts
+    if newCounts is None:
+        [newKeys,newCounts]=np.unique(newKeys,return_counts=True)
+        pass
+    allKeys=np.concatenate((keys,newKeys)).astype(np.int64)
+    [keys,inverse]=np.unique(allKeys,return_inverse=True)
+    merged=np.zeros(len(keys),dtype=np.int64)
+    np.add.at(merged,inverse,np.concatenate((counts,newCounts)))
+    return [keys,merged]
+
+
+def findClusters(hits,nColumns=52,nRows=80):
+    # group hits (an array of hitType) into clusters of pixels of the same
+    # event and ROC that touch at a side or corner. The hits are sorted by
+    # pixel, the neighbours of every hit are looked up in the sorted keys
+    # and the components are labelled by hooking their roots together
+    # until all neighbours share a root. Returns an array of clusterType
+    # ordered by event.
+    key=((hits["event"].astype(np.int64)*256+hits["roc"])*nColumns
+         +hits["column"])*nRows+hits["row"]
+    order=np.argsort(key,kind="mergesort")
+    key=key[order]
+    column=hits["column"][order].astype(np.int64)
+    row=hits["row"][order].astype(np.int64)
+    nHits=len(key)
+    # pairs of neighbours: the same pixel twice, and the pixels above, and
+    # to the right below, beside and above
+    first=[np.flatnonzero(key[1:]==key[:-1])]
+    second=[first[0]+1]
+    for [dx,dy] in [[0,1],[1,-1],[1,0],[1,1]]:
+        inside=np.flatnonzero((column+dx<nColumns)&(row+dy>=0)&(row+dy<nRows))
+        neighbour=key[inside]+dx*nRows+dy
+        position=np.minimum(np.searchsorted(key,neighbour),max(nHits-1,0))
+        found=key[position]==neighbour
+        first.append(inside[found])
+        second.append(position[found])
+        pass
+    first=np.concatenate(first)
+    second=np.concatenate(second)
+    labels=np.arange(nHits)
+    while True:
+        # point every hit at the root of its component
+        while True:
+            roots=labels[labels]
+            if np.array_equal(roots,labels):
+                break
+            labels=roots
+            pass
+        differ=labels[first]!=labels[second]
+        if not differ.any():
+            break
+        first=first[differ]
+        second=second[differ]
+        # hook the larger root of every pair under the smaller one
+        low=np.minimum(labels[first],labels[second])
+        high=np.maximum(labels[first],labels[second])
+        np.minimum.at(labels,high,low)
+        pass
+    [roots,cluster]=np.unique(labels,return_inverse=True)
+    clusters=np.zeros(len(roots),dtype=clusterType)
+    if len(roots)==0:
+        return clusters
+    byCluster=np.argsort(cluster,kind="mergesort")
+    begin=np.searchsorted(cluster[byCluster],np.arange(len(roots)))
+    clusters["event"]=hits["event"][order][roots]
+    clusters["roc"]=hits["roc"][order][roots]
+    clusters["size"]=np.bincount(cluster)
+    clusters["widthX"]=(np.maximum.reduceat(column[byCluster],begin)
+                        -np.minimum.reduceat(column[byCluster],begin)+1)
+    clusters["widthY"]=(np.maximum.reduceat(row[byCluster],begin)
+                        -np.minimum.reduceat(row[byCluster],begin)+1)
+    clusters["charge"]=np.bincount(cluster,weights=hits["pulseheight"][order])
+    return clusters
+
+
+class DecoderSummary:
+    # counts collected by the Decoder over a data file. Dense histograms
+    # are indexed by value (pulse height by value+1, so that the invalid
+    # pulse height -1 goes to bin 0), sparse ones are kept as sorted keys
+    # with counts: ROC headers and leftovers as (digits<<12|value) and
+    # (digits<<24|value) of their hex strings. Valid hits are counted in
+    # occupancy and their pulse heights summed in pulseheightSum, both
+    # indexed by ROC-1, column and row. Clusters (see Decoder.setClustering)
+    # are histogrammed per ROC-1 by size, widths and charge in unit bins,
+    # with larger values in the last bin. Data skipped as corrupt (see
+    # Decoder.setResync) are kept as sorted [begin,end) byte ranges of the
+    # file in corruptRanges.
+    sparse=["header","leftover","length"]
+    dense={"pulseheight":257,"status":32,"trigPhase":8,"nStacked":64}
+    pixelArrays=["occupancy","pulseheightSum"]
+    clusterHistograms={"clusterSize":32,"clusterWidthX":16,"clusterWidthY":16,
+                       "clusterCharge":1024}
+    nColumns=52
+    nRows=80
+    clockFrequency=40e6 # trailer timestamp counts per second
+
+    def __init__(self,numROCs=8):
+        self.numROCs=numROCs
+        self.nEvents=0
+        self.nHits=0
+        self.nInvalidHits=0
+        # fraction of the events of the file that were decoded
+        self.sampledFraction=1.0
+        # armed pixels in calibration mode (a boolean array like
+        # occupancy), None otherwise
+        self.expected=None
+        # blocks of per-event columns (eventColumnsType) if they are kept
+        self.eventBlocks=[]
+        self.corruptRanges=np.zeros((0,2),dtype=np.int64)
+        for name in self.sparse:
+            setattr(self,name+"Keys",np.zeros(0,dtype=np.int64))
+            setattr(self,name+"Counts",np.zeros(0,dtype=np.int64))
+            pass
+        for name,nbins in self.dense.items():
+            setattr(self,name,np.zeros(nbins,dtype=np.int64))
+            pass
+        for name in self.pixelArrays:
+            setattr(self,name,np.zeros((numROCs,self.nColumns,self.nRows),dtype=np.int64))
+            pass
+        for name,nbins in self.clusterHistograms.items():
+            setattr(self,name,np.zeros((numROCs,nbins),dtype=np.int64))
+            pass
+        return
+
+
+    def fill(self,name,values,counts=None):
+        # add values to one of the histograms
+        if name in self.dense:
+            if counts is None:
+                counts=np.bincount(values,minlength=self.dense[name])
+            else:
+                counts=np.bincount(values,weights=counts,minlength=self.dense[name])
+                pass
+            histogram=getattr(self,name)
+            histogram+=counts.astype(np.int64)
+        else:
+            [keys,counts]=addCounts(getattr(self,name+"Keys"),getattr(self,name+"Counts"),
+                                    values,counts)
+            setattr(self,name+"Keys",keys)
+            setattr(self,name+"Counts",counts)
+            pass
+        return
+
+
+    def fillPixels(self,roc,column,row,pulseheight):
+        # add decoded hits (arrays as from Decoder.decodePixels), hits with
+        # an invalid field are only counted in nInvalidHits. ROCs are
+        # numbered from 1 (pixels before the first ROC header have ROC 0),
+        # hits outside ROCs 1 to numROCs are counted in nHits but not in
+        # the pixel arrays.
+        self.nHits+=len(roc)
+        invalid=(roc<0)|(column<0)|(row<0)|(pulseheight<0)
+        self.nInvalidHits+=int(np.count_nonzero(invalid))
+        inside=(~invalid)&(roc>=1)&(roc<=self.numROCs)
+        pixel=((roc[inside]-1)*self.nColumns+column[inside])*self.nRows+row[inside]
+        nPixels=self.occupancy.size
+        self.occupancy+=np.bincount(pixel,minlength=nPixels).reshape(self.occupancy.shape)
+        pulseheightSum=np.bincount(pixel,weights=pulseheight[inside],minlength=nPixels)
+        self.pulseheightSum+=pulseheightSum.astype(np.int64).reshape(self.occupancy.shape)
+        return
+
+
+    def fillClusters(self,clusters):
+        # add clusters (an array of clusterType) of ROCs 1 to numROCs
+        clusters=clusters[(clusters["roc"]>=1)&(clusters["roc"]<=self.numROCs)]
+        for name,field in [["clusterSize","size"],["clusterWidthX","widthX"],
+                           ["clusterWidthY","widthY"],["clusterCharge","charge"]]:
+            histogram=getattr(self,name)
+            nbins=histogram.shape[1]
+            bins=(clusters["roc"].astype(np.int64)-1)*nbins\
+                  +np.minimum(clusters[field],nbins-1)
+            histogram+=np.bincount(bins,minlength=histogram.size).reshape(histogram.shape)
+            pass
+        return
+
+
+    def fillCorrupt(self,ranges):
+        # add byte ranges of corrupt data, ranges that touch are joined
+        ranges=np.concatenate((self.corruptRanges,np.asarray(ranges,dtype=np.int64).reshape(-1,2)))
+        ranges=ranges[np.argsort(ranges[:,0],kind="mergesort")]
+        # a range starts a new one unless it begins where those before end
+        newRange=np.ones(len(ranges),dtype=bool)
+        newRange[1:]=ranges[1:,0]>np.maximum.accumulate(ranges[:-1,1])
+        first=np.flatnonzero(newRange)
+        self.corruptRanges=np.column_stack((ranges[first,0],
+                                            np.maximum.reduceat(ranges[:,1],first)
+                                            if len(first)>0 else first))
+        return
+
+
+    def fillEvents(self,events):
+        # keep the trailer fields and payload length of a block of events
+        # (arrays as from Decoder.decodeTrailers)
+        block=np.zeros(len(events["size"]),dtype=eventColumnsType)
+        valid=events["validTrailer"]
+        block["valid"]=valid
+        for name in ["timestamp","roStatus","trigPhase","nStacked"]:
+            block[name]=np.where(valid,events[name],0)
+            pass
+        block["size"]=events["payloadLength"]
+        self.eventBlocks.append(block)
+        return
+
+
+    def eventColumns(self):
+        # per-event columns of all events kept so far
+        if len(self.eventBlocks)!=1:
+            self.eventBlocks=[np.concatenate([np.zeros(0,dtype=eventColumnsType)]
+                                             +self.eventBlocks)]
+            pass
+        return self.eventBlocks[0]
+
+
+    def eventTimes(self):
+        # times in seconds since the first event of the events with a
+        # valid trailer, unwrapping the 32-bit timestamps
+        timestamp=self.eventColumns()["timestamp"][self.eventColumns()["valid"]]
+        if len(timestamp)==0:
+            return np.zeros(0)
+        steps=np.diff(timestamp.astype(np.int64))&0xffffffff
+        ticks=np.concatenate(([0],np.cumsum(steps)))
+        return ticks/self.clockFrequency
+
+
+    def timeBins(self,binSeconds):
+        # time bin of every event with a valid trailer and the bin starts
+        times=self.eventTimes()
+        bins=(times/binSeconds).astype(np.int64)
+        nBins=0
+        if len(bins)>0:
+            nBins=bins[-1]+1
+            pass
+        return [bins,np.arange(nBins)*binSeconds]
+
+
+    def triggerRate(self,binSeconds=1.):
+        # start of the time bins and trigger rate in Hz in each of them
+        [bins,binStart]=self.timeBins(binSeconds)
+        counts=np.bincount(bins,minlength=len(binStart))
+        return [binStart,counts/binSeconds]
+
+
+    def stackingRate(self,binSeconds=1.):
+        # start of the time bins and, in each of them, the mean number of
+        # stacked triggers and the fraction of events with stacked
+        # triggers (0 for bins without events)
+        [bins,binStart]=self.timeBins(binSeconds)
+        nStacked=self.eventColumns()["nStacked"][self.eventColumns()["valid"]]
+        counts=np.maximum(np.bincount(bins,minlength=len(binStart)),1)
+        meanStacked=np.bincount(bins,weights=nStacked,minlength=len(binStart))/counts
+        stacked=np.bincount(bins,weights=nStacked>0,minlength=len(binStart))/counts
+        return [binStart,meanStacked,stacked]
+
+
+    def spills(self,minGap=1.):
+        # spills as groups of events separated by more than minGap seconds
+        # without triggers: start and end time and number of events of
+        # every spill
+        times=self.eventTimes()
+        if len(times)==0:
+            return [np.zeros(0),np.zeros(0),np.zeros(0,dtype=np.int64)]
+        gaps=np.flatnonzero(np.diff(times)>minGap)
+        first=np.concatenate(([0],gaps+1))
+        last=np.concatenate((gaps,[len(times)-1]))
+        return [times[first],times[last],last-first+1]
+
+
+    def add(self,other):
+        # add the counts of another summary
+        self.nEvents+=other.nEvents
+        self.nHits+=other.nHits
+        self.nInvalidHits+=other.nInvalidHits
+        for name in self.sparse:
+            self.fill(name,getattr(other,name+"Keys"),getattr(other,name+"Counts"))
+            pass
+        for name in self.dense.keys()+self.pixelArrays+self.clusterHistograms.keys():
+            histogram=getattr(self,name)
+            histogram+=getattr(other,name)
+            pass
+        self.eventBlocks+=other.eventBlocks
+        self.fillCorrupt(other.corruptRanges)
+        return self
+
+
+    def nHeaders(self):
+        return int(self.headerCounts.sum())
+
+
+    def missingHeaderFraction(self):
+        if self.nEvents==0:
+            return 0.
+        return (self.numROCs*self.nEvents-self.nHeaders())*1.0/self.numROCs/self.nEvents
+
+
+    def invalidHitFraction(self):
+        if self.nHits==0:
+            return 0.
+        return 1.0*self.nInvalidHits/self.nHits
+
+
+    def expectedHits(self):
+        # numbers of valid hits on armed and on other pixels
+        expected=int(self.occupancy[self.expected].sum())
+        return [expected,int(self.occupancy.sum())-expected]
+
+
+    def expectedHitFraction(self):
+        if self.nHits==0:
+            return 0.
+        return 1.0*self.expectedHits()[0]/self.nHits
+
+
+    def unexpectedHitFraction(self):
+        if self.nHits==0:
+            return 0.
+        return 1.0*self.expectedHits()[1]/self.nHits
+
+
+    def efficiency(self):
+        # hits per event of every armed pixel, 0 for the others
+        if self.nEvents==0:
+            return np.zeros(self.occupancy.shape)
+        return np.where(self.expected,self.occupancy*1.0/self.nEvents,0.)
+
+
+    def meanEfficiency(self):
+        # average efficiency of the armed pixels
+        nArmed=np.count_nonzero(self.expected)
+        if nArmed==0:
+            return 0.
+        return self.efficiency().sum()/nArmed
+
+
+    def meanClusterSize(self):
+        # average cluster size per ROC (sizes beyond the last bin counted
+        # as the last bin)
+        sizes=np.arange(self.clusterSize.shape[1])
+        return (self.clusterSize*sizes).sum(axis=1)*1.0/np.maximum(self.clusterSize.sum(axis=1),1)
+
+
+    def meanPulseheight(self):
+        # average pulse height per pixel, 0 for pixels without hits
+        return self.pulseheightSum*1.0/np.maximum(self.occupancy,1)
+
+
+    def corruptBytes(self):
+        return int((self.corruptRanges[:,1]-self.corruptRanges[:,0]).sum())
+
+
+    def headerMap(self):
+        # ROC header counts keyed by their hex string
+        return dict(("%0*x"%(key>>12,key&0xfff),int(count))
+                    for key,count in zip(self.headerKeys,self.headerCounts))
+
+
+    def leftoverMap(self):
+        # counts of leftovers between ROCs and trailer keyed by hex string
+        return dict(("%0*x"%(key>>24,key&0xffffff),int(count))
+                    for key,count in zip(self.leftoverKeys,self.leftoverCounts))
+
+
+    def save(self,filename):
+        # write all counts to a .npz file, see loadDecoderSummary
+        arrays={"numROCs":self.numROCs,"nEvents":self.nEvents,"nHits":self.nHits,
+                "nInvalidHits":self.nInvalidHits,"sampledFraction":self.sampledFraction}
+        for name in self.sparse:
+            arrays[name+"Keys"]=getattr(self,name+"Keys")
+            arrays[name+"Counts"]=getattr(self,name+"Counts")
+            pass
+        for name in self.dense.keys()+self.pixelArrays+self.clusterHistograms.keys():
+            arrays[name]=getattr(self,name)
+            pass
+        arrays["corruptRanges"]=self.corruptRanges
+        if self.expected is not None:
+            arrays["expected"]=self.expected
+            pass
+        if len(self.eventBlocks)>0:
+            arrays["events"]=self.eventColumns()
+            pass
+        np.savez_compressed(filename,**arrays)
+        return
+
+
+def loadDecoderSummary(filename):
+    # summary written by DecoderSummary.save
+    arrays=np.load(filename)
+    summary=DecoderSummary(int(arrays["numROCs"]))
+    for name in ["nEvents","nHits","nInvalidHits"]:
+        setattr(summary,name,int(arrays[name]))
+        pass
+    summary.sampledFraction=float(arrays["sampledFraction"])
+    if "events" in arrays.files:
+        summary.eventBlocks=[arrays["events"]]
+        pass
+    for name in arrays.files:
+        if name not in ["numROCs","nEvents","nHits","nInvalidHits","sampledFraction",
+                        "events"]:
+            setattr(summary,name,arrays[name])
+            pass
+        pass
+    arrays.close()
+    return summary
+
+
+def hitFileNames(prefix):
+    # chunk files <prefix>_<n>.npy written by Decoder.exportHits, in order
+    chunks=[]
+    for filename in glob.glob(prefix+"_*.npy"):
+        number=filename[len(prefix)+1:-4]
+        if number.isdigit():
+            chunks.append([int(number),filename])
+            pass
+        pass
+    return [filename for [number,filename] in sorted(chunks)]
+
+
+def loadHits(filename):
+    # one chunk of hits, memory-mapped
+    return np.load(filename,mmap_mode="r")
+
+
+def iterHitColumn(prefix,name):
+    # generator over one column (event, roc, column, row or pulseheight)
+    # of the hits written by Decoder.exportHits, one memory-mapped chunk
+    # at a time
+    for filename in hitFileNames(prefix):
+        yield loadHits(filename)[name]
+        pass
+    return
+
 
 class Decoder:
 
@@ -7,15 +488,74 @@ class Decoder:
         self.numROCs = 8
         self.trailerLength = 15
         self.numEvents=0
+        self.blockWords=1<<22 # words read at once by the binary decoder
+        self.numWorkers=1
+        self.prescale=1
+        self.sampleEvents=None
+        self.keepEvents=False
+        self.clustering=False
+        self.resync=False
+        self.maxEventSize=1<<20 # largest event accepted by the resync framing
         self.clearExpectedPixels()
+        self.buildPixelTables()
         return
 
 
     def setNumROCs(self,numROCs):
         self.numROCs = numROCs
+        if self.expectedMask is not None:
+            # keep the armed pixels of the ROCs that are still there
+            mask=self.expectedMask
+            self.expectedMask=None
+            n=min(len(mask),numROCs)
+            self.getExpectedMask()[:n]=mask[:n]
+            pass
         return
 
     
+    def setNumWorkers(self,numWorkers):
+        # number of processes decoding parts of a binary file in parallel
+        self.numWorkers = numWorkers
+        return
+
+
+    def setPrescale(self,prescale):
+        # decode only every prescale-th event of binary files
+        self.prescale = prescale
+        return
+
+
+    def setKeepEvents(self,keepEvents):
+        # keep per-event trailer columns in the summary, for rates and
+        # spill structure
+        self.keepEvents = keepEvents
+        return
+
+
+    def setClustering(self,clustering):
+        # group the valid hits of every event into clusters and histogram
+        # them in the summary (binary decoder only)
+        self.clustering = clustering
+        return
+
+
+    def setResync(self,resync):
+        # frame binary files by validating every event: an event is taken
+        # only if its size is plausible and the next header (or the end of
+        # the file) follows right after its padded trailer. Data between
+        # valid events are skipped and counted as corrupt instead of being
+        # analyzed and printed.
+        self.resync = resync
+        return
+
+
+    def setSampleEvents(self,nEvents):
+        # decode only nEvents events spread evenly through binary files
+        # (None to decode all)
+        self.sampleEvents = nEvents
+        return
+
+
     def setROCVersion(self,version):
         if version==0:
             print "Decoder: assuming ROCs with inverted address levels"
@@ -23,78 +563,145 @@ class Decoder:
             print "Decoder: assuming v2 digital ROCs"
             pass
         self.rocType = version
+        self.buildPixelTables()
         return
 
 
     def printEventString(self,eventString):
+        # formatted events of a hex dump with one word per line, see
+        # formatEvents
         words=eventString.split("\n")
-        words.append("ffffffff")
-        eventPrintout=""
-        eventLength=0
-        ipos=0
-        iword=0
-        formattedString=""
-        while ipos<len(words):
-            word=words[ipos]
-            if word=="ffffffff" and ipos>0:
-                # process previous event
-                evEnd=2*(16+eventLength-self.trailerLength)+4 # +4 for spacers in header
-                trEnd=2*(16+eventLength)+4    # +4 for spacers in header
-                if eventLength>0 and len(formattedString)>=trEnd:
-                    formattedString=formattedString[:evEnd]+" "\
-                                     +formattedString[evEnd:evEnd+8]+"."\
-                                     +formattedString[evEnd+8:evEnd+16]+"."\
-                                     +formattedString[evEnd+16:evEnd+26]+"."\
-                                     +formattedString[evEnd+26:trEnd]
-                    pass
-                eventPrintout+=formattedString+"\n"
-                # initialize for next event
-                formattedString=""
-                eventLength=-1
-                iword=0
+        return "".join([event+"\n" for event in self.formatEvents(words)])
+
+
+    def formatEvents(self,words):
+        # generator over the events of a list of hex words, formatted as
+        # header words separated by dots, a space, the payload bytes and
+        # the trailer split up by dots. Every ffffffff after the first
+        # word starts a new event.
+        event=[]
+        for word in words:
+            if word=="ffffffff" and len(event)>0:
+                yield self.formatEventWords(event)
+                event=[]
                 pass
+            event.append(word)
+            pass
+        if len(event)>0:
+            yield self.formatEventWords(event)
+            pass
+        return
+
+
+    def formatEventWords(self,words):
+        # one event of formatEvents from the list of its hex words
+        eventLength=0
+        parts=[]
+        for iword in range(len(words)):
+            word=words[iword]
             if iword<2:
-                formattedString+=word+"."
+                parts.append(word+".")
             elif iword==2:
-                formattedString+=word+"."
+                parts.append(word+".")
                 eventLength=int(word,16)
             elif iword==3:
-                formattedString+=word+" "
+                parts.append(word+" ")
             else:
-                formattedString+=word[6:8]+word[4:6]+word[2:4]+word[0:2]
+                parts.append(word[6:8]+word[4:6]+word[2:4]+word[0:2])
+                pass
+            pass
+        formattedString="".join(parts)
+        evEnd=2*(16+eventLength-self.trailerLength)+4 # +4 for spacers in header
+        trEnd=2*(16+eventLength)+4    # +4 for spacers in header
+        if eventLength>0 and len(formattedString)>=trEnd:
+            formattedString=formattedString[:evEnd]+" "\
+                             +formattedString[evEnd:evEnd+8]+"."\
+                             +formattedString[evEnd+8:evEnd+16]+"."\
+                             +formattedString[evEnd+16:evEnd+26]+"."\
+                             +formattedString[evEnd+26:trEnd]
+            pass
+        return formattedString
+
+
+    def dumpEvents(self,filename,output,first=None,last=None,numbers=None):
+        # write the formatted events (see formatEvents) of a binary file
+        # with event numbers first<=number<=last, or in the list numbers,
+        # to the file-like output. Events are found with the event index
+        # and read one at a time. Returns the number of events written.
+        index=self.eventIndex(filename)
+        eventNumbers=index["event"].astype(np.int64)
+        if numbers is not None:
+            selected=np.in1d(eventNumbers,np.asarray(numbers,dtype=np.int64))
+        else:
+            selected=np.ones(len(index),dtype=bool)
+            pass
+        if first is not None:
+            selected&=eventNumbers>=first
+            pass
+        if last is not None:
+            selected&=eventNumbers<=last
+            pass
+        datafile=open(filename,"rb")
+        try:
+            for ievent in np.flatnonzero(selected):
+                words=self.readEvent(filename,ievent,index,datafile)
+                for event in self.formatEvents(["%08x"%word for word in words]):
+                    output.write(event+"\n")
+                    pass
                 pass
-            iword+=1
-            ipos+=1
+        finally:
+            datafile.close()
             pass
-        return eventPrintout
-                
+        return int(np.count_nonzero(selected))
+
 
     def clearExpectedPixels(self):
+        # leave calibration mode
         self.expectedPixelRows=[]
         self.expectedPixelColumns=[]
         self.expectedRocNums=[]
-        self.allExpectedRows=[]
-        self.allExpectedColumns=[]
-        self.allExpectedRocNums=[]
+        self.expectedMask=None
         return
 
     def addExpectedPixel(self,rocnum,row,column):
         # register an armed pixel, i.e. one that *should* be in the readout.
+        # ROCs are numbered from 1 as in the decoded pixels.
+        self.checkRocNum(rocnum)
         self.expectedPixelRows.append(row)
         self.expectedPixelColumns.append(column)
         self.expectedRocNums.append(rocnum)
-        if not row in self.allExpectedRows:
-            self.allExpectedRows.append(row)
-            self.allExpectedRows.sort()
-            pass
-        if not column in self.allExpectedColumns:
-            self.allExpectedColumns.append(column)
-            self.allExpectedColumns.sort()
+        self.getExpectedMask()[rocnum-1,column,row]=True
+        return
+
+
+    def setExpectedPixels(self,mask,rocnum=None):
+        # register the armed pixels of ROC rocnum (all ROCs if None) in
+        # bulk, given as a boolean mask indexed by column and row
+        mask=np.asarray(mask,dtype=bool)
+        if rocnum is None:
+            self.getExpectedMask()[:]=mask
+        else:
+            self.checkRocNum(rocnum)
+            self.getExpectedMask()[rocnum-1]=mask
             pass
-        if not rocnum in self.allExpectedRocNums:
-            self.allExpectedRocNums.append(rocnum)
-            self.allExpectedRocNums.sort()
         return
+
+
+    def checkRocNum(self,rocnum):
+        # ROC numbers count from 1, a 0 would silently index the last ROC
+        if rocnum<1 or rocnum>self.numROCs:
+            raise ValueError("Decoder: ROC number %s not in 1..%s" % (rocnum,self.numROCs))
+        return
+
+
+    def getExpectedMask(self):
+        # armed pixels of all ROCs indexed by ROC-1, column and row. Setting
+        # the first armed pixel starts the calibration mode.
+        if self.expectedMask is None:
+            self.expectedMask=np.zeros((self.numROCs,DecoderSummary.nColumns,
+                                        DecoderSummary.nRows),dtype=bool)
+            pass
+        return self.expectedMask
     
     
     def pixelDecoder(self,hexstring):
@@ -111,42 +718,64 @@ class Decoder:
             value=int(hexstring.split("_")[1],16)
         except:
             return [roc,-1,-1,-1]
-        binstring=""
-        for ibit in range(24):
-            binstring=str((value>>ibit)&1)+binstring
-            pass
+        # look up address and pulse height fields, see buildPixelTables
+        column=self.columnTable[((value>>17)&0x7e)|((value>>9)&1)]
+        row=self.rowTable[(value>>9)&0x1ff]
+        pulseheight=self.pulseheightTable[value&0x1ff]
+        return [roc,column,row,pulseheight]
 
-        # column address
-        column1=int(binstring[0:3],2)
-        column2=int(binstring[3:6],2)
-        doublecolumn=6*column1+column2
-        if column1<=5 and column2<=5 and doublecolumn<=25:
-            column=2*doublecolumn
-        else:
-            doublecolumn=-1
-            column=-1
-            pass
-        # row address (inverted in current revision of the ROC!)
-        row1=int(binstring[6:9],2)
-        row2=int(binstring[9:12],2)
-        row3=int(binstring[12:15],2)            
-        if self.rocType==0:
-            row1=7-row1
-            row2=7-row2
-            row3=7-row3
-            pass
-        if column>=0: column+=row3&1
-        if row1>5 or row2>5 or row3>5:
+
+    def buildPixelTables(self):
+        # lookup tables for the fields of a 24-bit pixel word:
+        # bits 23-18 (two column digits) together with bit 9 (lowest bit
+        # of the last row digit) give the column, bits 17-9 (three row
+        # digits) the row and bits 8-0 the pulse height with the zero bit
+        # in the middle. Row digits are inverted for rocType 0.
+        self.columnTable=[]
+        for index in range(128):
+            column1=index>>4
+            column2=(index>>1)&7
+            doublecolumn=6*column1+column2
+            parity=index&1
+            if self.rocType==0:
+                parity=1-parity
+                pass
+            if column1<=5 and column2<=5 and doublecolumn<=25:
+                self.columnTable.append(2*doublecolumn+parity)
+            else:
+                self.columnTable.append(-1)
+                pass
+            pass
+        self.rowTable=[]
+        for index in range(512):
+            row1=index>>6
+            row2=(index>>3)&7
+            row3=index&7
+            if self.rocType==0:
+                row1=7-row1
+                row2=7-row2
+                row3=7-row3
+                pass
             row=-1
-        else:
-            row=80-(row3+6*row2+36*row1)/2
-            if row<0 or row>79: row=-1
+            if row1<=5 and row2<=5 and row3<=5:
+                row=80-(row3+6*row2+36*row1)/2
+                if row<0 or row>79: row=-1
+                pass
+            self.rowTable.append(row)
             pass
-        # pulseheight including zero bit in the middle
-        pulseheight=int(binstring[15:19]+binstring[20:24],2)
-        zero=int(binstring[19],2)
-        if zero!=0: pulseheight=-1
-        return [roc,column,row,pulseheight]
+        self.pulseheightTable=[]
+        for index in range(512):
+            if index&0x10:
+                self.pulseheightTable.append(-1)
+            else:
+                self.pulseheightTable.append(((index>>1)&0xf0)|(index&0xf))
+                pass
+            pass
+        # array copies for decodePixels
+        self.columnArray=np.array(self.columnTable,dtype=np.int64)
+        self.rowArray=np.array(self.rowTable,dtype=np.int64)
+        self.pulseheightArray=np.array(self.pulseheightTable,dtype=np.int64)
+        return
 
     
     def analyzeOneEvent(self,eventString):
@@ -171,231 +800,1187 @@ class Decoder:
         return [headers,leftovers,pixels]
 
 
-    def checkDataIntegrity(self,filename,binary=0, max_nEvents=None):
+    def checkDataIntegrity(self,filename,binary=0, max_nEvents=None, summaryFile=None):
+        # binary files and text files (one hex word per line) go through
+        # the vectorized decoder. Prints the summary, and returns it as a
+        # DecoderSummary, which is also saved to summaryFile if given.
+        # setSampleEvents and setNumWorkers apply to binary files only.
+        if binary and self.sampleEvents is not None:
+            summary=self.decodeSampledEvents(filename,self.sampleEvents)
+        elif binary and self.numWorkers>1:
+            summary=self.decodeBinaryFileParallel(filename,max_nEvents)
+        else:
+            summary=self.decodeBinaryFile(filename,max_nEvents,not binary)
+            pass
+        self.printSummary(summary)
+        if summaryFile is not None:
+            summary.save(summaryFile)
+            pass
+        return summary
+
+
+    def newSummary(self):
+        summary=DecoderSummary(self.numROCs)
+        summary.expected=self.expectedMask
+        return summary
+
+
+    def decodeBinaryFile(self,filename,max_nEvents=None,text=False):
+        # vectorized decoder for binary files (or text files if text is
+        # set): events are read in blocks by iterEventBlocks and analyzed
+        # with array operations. Gives the same counts as the original
+        # word-by-word decoder.
+        summary=self.newSummary()
+        if max_nEvents is not None:
+            maxEvents=max_nEvents+1 # the word-by-word decoder stopped after one more event
+        else:
+            maxEvents=None
+            pass
         nEvents=0
-        headerMap={}
-        leftoverMap={}
-        lengthMap={}
-        pixelMap={}
-        pulseheightMap={}
-        statusMap={}
-        trigPhaseMap={}
-        nStackedMap={}
-        posInEvent=0
-        rocData=""
-        eventSize=0
-        if binary:
-            datafile=open(filename,"rb")
+        for [data,events] in self.iterEventBlocks(filename,0,maxEvents,text):
+            nEvents+=len(events["size"])
+            self.analyzeEvents(data,self.prescaleEvents(events,events["index"]),summary)
+            pass
+        if maxEvents is not None and nEvents>=maxEvents:
+            print 'Reaching the max events for DQM: ', max_nEvents 
+            pass
+        if nEvents>0:
+            summary.sampledFraction=1.0*summary.nEvents/nEvents
+            pass
+        return summary
+
+
+    def decodeBinaryFileParallel(self,filename,max_nEvents=None):
+        # decodeBinaryFile with the file split into byte ranges at event
+        # headers (taken from the event index), which are analyzed by a
+        # pool of self.numWorkers processes. Counts and printout of the ranges
+        # are merged in file order, so the result is the same.
+        if max_nEvents is not None:
+            maxEvents=max_nEvents+1 # the word-by-word decoder stopped after one more event
         else:
-            datafile=open(filename,"r")
-            pass
-        # loop over all words in the file plus an additional marker
-        lastline=0
-        while lastline==0:
-            if binary:
-                try:
-                    word=datafile.read(4)
-                    entry="%08x"%struct.unpack("<I",word)
-                except:
-                    entry="ffffffff"
-                    lastline=1
-                    pass
+            maxEvents=None
+            pass
+        index=self.eventIndex(filename)
+        nEvents=len(index)
+        if maxEvents is not None:
+            nEvents=min(nEvents,maxEvents)
+            pass
+        if nEvents==0:
+            # nothing to split, but there may be corrupt data to report
+            return self.decodeBinaryFile(filename,max_nEvents)
+        # a few ranges per worker of about the same number of bytes
+        nRanges=max(min(4*self.numWorkers,nEvents),1)
+        offsets=index["offset"][:nEvents].astype(np.int64)
+        if nEvents<len(index):
+            end=int(index["offset"][nEvents])
+        else:
+            end=os.path.getsize(filename)
+            pass
+        starts=np.searchsorted(offsets,np.linspace(0,end,nRanges+1)[:-1])
+        starts=np.unique(np.append(starts,0))
+        ranges=[]
+        for irange in range(len(starts)):
+            first=int(starts[irange])
+            if first>=nEvents:
+                break
+            if irange+1<len(starts) and starts[irange+1]<nEvents:
+                byteLimit=int(offsets[starts[irange+1]])
+            elif nEvents<len(index):
+                byteLimit=end
+            else:
+                byteLimit=None
                 pass
+            if first>0:
+                byteStart=int(offsets[first])
+                lastSize=int(index["size"][first-1])
             else:
-                line=datafile.readline()
-                if line=="":
-                    line="ffffffff"
-                    lastline=1
+                # from the start of the file, which may begin with
+                # corrupt data before the first (valid) header
+                byteStart=0
+                lastSize=0
+                pass
+            ranges.append((self,filename,byteStart,byteLimit,lastSize,first))
+            pass
+        pool=multiprocessing.Pool(self.numWorkers)
+        try:
+            results=pool.map(decodeByteRange,ranges)
+        finally:
+            pool.close()
+            pool.join()
+            pass
+        summary=self.newSummary()
+        for [rangeSummary,printout] in results:
+            sys.stdout.write(printout)
+            summary.add(rangeSummary)
+            pass
+        if maxEvents is not None and len(index)>=maxEvents:
+            print 'Reaching the max events for DQM: ', max_nEvents 
+            pass
+        if nEvents>0:
+            summary.sampledFraction=1.0*summary.nEvents/nEvents
+            pass
+        return summary
+
+
+    def decodeByteRange(self,filename,byteStart=0,byteLimit=None,lastSize=0,
+                        firstEvent=0):
+        # analyze the events between two event headers of a binary file,
+        # firstEvent is the number of the first one in the file
+        summary=self.newSummary()
+        blocks=self.readEventBlocks(filename,byteLimit,byteStart,lastSize)
+        for [words,events,firstWord,resume] in blocks:
+            data=words.view(np.uint8)
+            events=self.decodeTrailers(data,events,firstWord)
+            nBlock=len(events["size"])
+            events=self.prescaleEvents(events,np.arange(firstEvent,firstEvent+nBlock))
+            firstEvent+=nBlock
+            self.analyzeEvents(data,events,summary)
+            pass
+        return summary
+
+
+    def prescaleEvents(self,events,eventIndex):
+        # the events of a block with eventIndex (count in the file) a
+        # multiple of self.prescale
+        if self.prescale<=1:
+            return events
+        selected=(eventIndex%self.prescale)==0
+        selectedEvents={}
+        for key in events.keys():
+            if key=="corrupt":
+                selectedEvents[key]=events[key]
+            else:
+                selectedEvents[key]=events[key][selected]
+                pass
+            pass
+        return selectedEvents
+
+
+    def decodeSampledEvents(self,filename,nSample):
+        # decode nSample events spread evenly through a binary file. With
+        # an up to date event index the events are taken from it, otherwise
+        # reading starts at the first event header after evenly spaced byte
+        # offsets. The sampled fraction is estimated from the bytes read.
+        summary=self.newSummary()
+        index=self.loadEventIndex(filename)
+        fileSize=os.path.getsize(filename)
+        if index is not None:
+            picks=np.unique(np.linspace(0,len(index)-1,nSample).round().astype(np.int64))
+            ranges=[]
+            for ievent in picks[picks>=0]:
+                byteLimit=None
+                if ievent+1<len(index):
+                    byteLimit=int(index["offset"][ievent+1])
                     pass
-                entry=line.strip()
-                pass
-            if entry=="ffffffff" and eventSize>0:
-                # analyze previous event
-                payload=rocData[:2*(eventSize-self.trailerLength)]
-                trailer=rocData[2*(eventSize-self.trailerLength):2*eventSize]
-                if len(trailer)!=2*self.trailerLength:
-                    # this trailer is invalid.
-                    print "ERROR: checkDataIntegrity has trailer of"\
-                          +" invalid length:",len(trailer),"digits"
-                    print "      ",payload,trailer
-                else:
-                    # analyze trailer
-                    
-                    # timestamp (only lowest 32 bits for now)
-                    timestamp = (int(trailer[16:18],16)<<8)\
-                                +(int(trailer[18:20],16)<<16)\
-                                +(int(trailer[20:22],16)<<24)\
-                                +(int(trailer[24:26],16))
-
-                    # stacking level of triggers
-                    if len(rocData)>2*eventSize-4:
-                        byteval=int(trailer[2*self.trailerLength-4:2*self.trailerLength-2],16)
-                        nStacked=byteval&0x3f
-                    else:
-                        nStacked="?"
-                        pass
-                    if nStacked in nStackedMap.keys():
-                        nStackedMap[nStacked]+=1
-                    else:
-                        nStackedMap[nStacked]=1
-                        pass
-                    # trigger phase (useless for internal triggers, but important for external)
-                    # and readout status
-                    if len(rocData)>2*eventSize-2:
-                        byteval=int(trailer[2*self.trailerLength-2:2*self.trailerLength],16)
-                        roStatus=byteval&0x1f
-                        trigPhase=(byteval&0xe0)>>5
-                    else:
-                        roStatus="?"
-                        trigPhase="?"
-                        pass
-                    if roStatus in statusMap.keys():
-                        statusMap[roStatus]+=1
-                    else:
-                        statusMap[roStatus]=1
-                        pass
-                    if trigPhase in trigPhaseMap.keys():
-                        trigPhaseMap[trigPhase]+=1
-                    else:
-                        trigPhaseMap[trigPhase]=1
-                        pass
-                    # debug output
-                    #print "event status=",roStatus,"nStacked=",nStacked,"length=",len(rocData)
+                lastSize=0
+                if ievent>0:
+                    lastSize=int(index["size"][ievent-1])
                     pass
-                # split payload into individual ROC headers and pixels 
-                [headers,leftovers,pixels]=self.analyzeOneEvent(payload)
-                for entry in headers:
-                    if entry in headerMap.keys():
-                        headerMap[entry]+=1
-                    else:
-                        headerMap[entry]=1
+                ranges.append([int(index["offset"][ievent]),byteLimit,lastSize])
+                pass
+        else:
+            ranges=[]
+            datafile=open(filename,"rb")
+            try:
+                for start in range(nSample):
+                    eventRange=self.findEventAt(datafile,fileSize*start/nSample/4*4)
+                    if eventRange is not None and eventRange not in ranges:
+                        ranges.append(eventRange)
                         pass
                     pass
-                for entry in leftovers:
-                    if entry in leftoverMap.keys():
-                        leftoverMap[entry]+=1
-                    else:
-                        leftoverMap[entry]=1
-                        pass
-                for entry in pixels:
-                    # replace pulse height by 255
-                    # so we can compare pixel addresses more easily
-                    [roc,col,row,pulseheight]=self.pixelDecoder(entry)
-                    if pulseheight in pulseheightMap.keys():
-                        pulseheightMap[pulseheight]+=1
-                    else:
-                        pulseheightMap[pulseheight]=1
-                        pass
-                    entry2=entry.split("_")[0]+"_%06x"%(int(entry.split("_")[1],16)|0x1ef)
-                    if entry2 in pixelMap.keys():
-                        pixelMap[entry2]+=1
-                    else:
-                        pixelMap[entry2]=1
+            finally:
+                datafile.close()
+                pass
+            pass
+        nBytes=0
+        for [byteStart,byteLimit,lastSize] in ranges:
+            summary.add(self.decodeByteRange(filename,byteStart,byteLimit,lastSize))
+            if byteLimit is None:
+                byteLimit=fileSize
+                pass
+            nBytes+=byteLimit-byteStart
+            pass
+        if index is not None and len(index)>0:
+            summary.sampledFraction=1.0*len(ranges)/len(index)
+        elif fileSize>0:
+            summary.sampledFraction=1.0*nBytes/fileSize
+            pass
+        return summary
+
+
+    def findEventAt(self,datafile,byteStart,chunkWords=4096):
+        # byte offsets of the first event header at or after byteStart and
+        # of the next header (None at the end of the file), None if there
+        # is no header left
+        datafile.seek(byteStart)
+        header=None
+        position=byteStart/4
+        while True:
+            chunk=np.fromfile(datafile,dtype="<u4",count=chunkWords)
+            markers=np.flatnonzero(chunk==0xffffffff)+position
+            if header is not None and len(markers)>0:
+                return [4*header,4*int(markers[0]),0]
+            if header is None and len(markers)>1:
+                return [4*int(markers[0]),4*int(markers[1]),0]
+            if header is None and len(markers)>0:
+                header=int(markers[0])
+                pass
+            if len(chunk)<chunkWords:
+                break
+            position+=len(chunk)
+            pass
+        if header is None:
+            return None
+        return [4*header,None,0]
+
+
+    def checkBoardSync(self,filename,otherFilename,maxDrift=0,maxListed=100):
+        # compare the events of the binary files of two boards in one pass:
+        # events are joined on their event number block by block, assuming
+        # increasing event numbers. Returns a dict with the event counts,
+        # the (first maxListed) event numbers missing in the other file
+        # and extra in it, the timestamp drift of matched events relative
+        # to the first match (in timestamp counts) and the first event
+        # number at which the files are out of sync, i.e. an event is
+        # missing on one side or the drift exceeds maxDrift.
+        report={"nEvents":[0,0],"nMatched":0,"nMissing":0,"nExtra":0,
+                 "missing":[],"extra":[],"firstOffset":None,"maxDrift":0,
+                 "lastDrift":0,"firstDesync":None,"desyncReason":None}
+        streams=[self.iterSyncColumns(filename),self.iterSyncColumns(otherFilename)]
+        empty=np.zeros(0,dtype=np.int64)
+        pending=[[empty,empty],[empty,empty]]
+        done=[False,False]
+        # how far each file has been read: the smallest of the last 16
+        # event numbers, so that single out of order numbers do not stop
+        # the reading. Files are read further where this is not beyond the
+        # events joined so far.
+        last=[None,None]
+        tails=[empty,empty]
+        bound=None
+        while True:
+            for side in [0,1]:
+                while not done[side] and (len(pending[side][0])==0 or last[side]<=bound):
+                    try:
+                        [numbers,timestamps]=streams[side].next()
+                    except StopIteration:
+                        done[side]=True
+                        break
+                    report["nEvents"][side]+=len(numbers)
+                    pending[side]=[np.concatenate((pending[side][0],numbers)),
+                                   np.concatenate((pending[side][1],timestamps))]
+                    tails[side]=np.concatenate((tails[side],numbers))[-16:]
+                    last[side]=tails[side].min()
+                    pass
+                pass
+            if len(pending[0][0])==0 and len(pending[1][0])==0:
+                break
+            if done[0] or done[1]:
+                bound=None
+            else:
+                bound=min(last[0],last[1])
+                pass
+            joined=[]
+            for side in [0,1]:
+                [numbers,timestamps]=pending[side]
+                if bound is None:
+                    selected=np.ones(len(numbers),dtype=bool)
+                else:
+                    selected=numbers<=bound
+                    pass
+                joined.append([numbers[selected],timestamps[selected]])
+                pending[side]=[numbers[~selected],timestamps[~selected]]
+                pass
+            self.joinSyncColumns(joined[0],joined[1],report,maxDrift,maxListed)
+            pass
+        return report
+
+
+    def iterSyncColumns(self,filename):
+        # event numbers and timestamps (-1 for invalid trailers) of the
+        # events of a binary file, block by block
+        for [data,events] in self.iterEventBlocks(filename):
+            if len(events["size"])>0:
+                yield [events["eventNumber"].astype(np.int64),events["timestamp"]]
+                pass
+            pass
+        return
+
+
+    def joinSyncColumns(self,columns,otherColumns,report,maxDrift,maxListed):
+        # add the comparison of two sets of events to report, see
+        # checkBoardSync
+        [numbers,timestamps]=columns
+        [otherNumbers,otherTimestamps]=otherColumns
+        [common,first,other]=np.intersect1d(numbers,otherNumbers,return_indices=True)
+        missing=np.setdiff1d(numbers,otherNumbers)
+        extra=np.setdiff1d(otherNumbers,numbers)
+        report["nMatched"]+=len(common)
+        report["nMissing"]+=len(missing)
+        report["nExtra"]+=len(extra)
+        report["missing"]+=[int(n) for n in missing[:maxListed-len(report["missing"])]]
+        report["extra"]+=[int(n) for n in extra[:maxListed-len(report["extra"])]]
+        # timestamp offset between the boards, modulo 2^32
+        valid=(timestamps[first]>=0)&(otherTimestamps[other]>=0)
+        offset=(otherTimestamps[other]-timestamps[first])&0xffffffff
+        offset=np.where(offset>=1<<31,offset-(1<<32),offset)[valid]
+        common=common[valid]
+        if len(offset)>0:
+            if report["firstOffset"] is None:
+                report["firstOffset"]=int(offset[0])
+                pass
+            drift=offset-report["firstOffset"]
+            report["maxDrift"]=max(report["maxDrift"],int(np.abs(drift).max()))
+            report["lastDrift"]=int(drift[-1])
+        else:
+            drift=offset
+            pass
+        if report["firstDesync"] is None:
+            candidates=[]
+            if len(missing)>0:
+                candidates.append([int(missing[0]),"event missing in the other file"])
+                pass
+            if len(extra)>0:
+                candidates.append([int(extra[0]),"extra event in the other file"])
+                pass
+            drifting=np.flatnonzero(np.abs(drift)>maxDrift)
+            if len(drifting)>0:
+                candidates.append([int(common[drifting[0]]),"timestamp drift"])
+                pass
+            if len(candidates)>0:
+                [report["firstDesync"],report["desyncReason"]]=min(candidates)
+                pass
+            pass
+        return
+
+
+    def printBoardSync(self,report):
+        print "board sync: events",report["nEvents"][0],"and",report["nEvents"][1],\
+              "matched",report["nMatched"]
+        print "         missing in the other file:",report["nMissing"],report["missing"]
+        print "         extra in the other file:",report["nExtra"],report["extra"]
+        print "         timestamp offset:",report["firstOffset"],\
+              "drift max:",report["maxDrift"],"last:",report["lastDrift"]
+        if report["firstDesync"] is None:
+            print "         boards in sync"
+        else:
+            print "         first desync at event",report["firstDesync"],\
+                  "("+report["desyncReason"]+")"
+            pass
+        return
+
+
+    def newFollowState(self):
+        # state kept by followFile between polls: where to resume reading
+        # (header of the unfinished event) with the size carried along,
+        # the file size seen last and the cumulative summary
+        return {"offset":0,"lastSize":0,"fileSize":0,"finished":False,
+                "summary":self.newSummary()}
+
+
+    def followFile(self,filename,state=None,complete=False):
+        # decode the events appended to a binary file that is still being
+        # written since the previous call, adding them to the summary in
+        # state. The last event stays open until the next header arrives,
+        # or until the file is complete. Returns the updated state.
+        if state is None:
+            state=self.newFollowState()
+            pass
+        fileSize=os.path.getsize(filename)
+        if fileSize<state["fileSize"]:
+            # the file has been replaced, start over
+            state=self.newFollowState()
+            pass
+        state["fileSize"]=fileSize
+        if state["finished"]:
+            return state
+        blocks=self.readEventBlocks(filename,None,state["offset"],
+                                    state["lastSize"],complete)
+        for [words,events,firstWord,resume] in blocks:
+            data=words.view(np.uint8)
+            events=self.decodeTrailers(data,events,firstWord)
+            self.analyzeEvents(data,events,state["summary"])
+            if resume is None:
+                state["finished"]=True
+            else:
+                [state["offset"],state["lastSize"]]=resume
+                pass
+            pass
+        if complete:
+            state["finished"]=True
+            pass
+        return state
+
+
+    def followDataFile(self,filename,doneFile,interval=60,stateFile=None):
+        # poll a binary file while it is written and print the cumulative
+        # summary after every poll, until doneFile (e.g. the transfer
+        # marker) shows up. interval=None polls only once. With a stateFile
+        # the state is saved after every poll, and a later call continues
+        # from there instead of from the beginning of the file.
+        state=None
+        if stateFile is not None:
+            state=self.loadFollowState(stateFile)
+            pass
+        while True:
+            complete=os.path.exists(doneFile)
+            state=self.followFile(filename,state,complete)
+            if stateFile is not None:
+                self.saveFollowState(state,stateFile)
+                pass
+            self.printSummary(state["summary"])
+            sys.stdout.flush()
+            if complete or interval is None:
+                break
+            time.sleep(interval)
+            pass
+        return state
+
+
+    def saveFollowState(self,state,stateFile):
+        statefile=open(stateFile+".tmp","wb")
+        cPickle.dump(state,statefile,2)
+        statefile.close()
+        os.rename(stateFile+".tmp",stateFile)
+        return
+
+
+    def loadFollowState(self,stateFile):
+        # state saved by saveFollowState, None if there is none
+        try:
+            statefile=open(stateFile,"rb")
+        except IOError:
+            return None
+        state=cPickle.load(statefile)
+        statefile.close()
+        return state
+
+
+    def iterEvents(self,filename,start=0,stop=None):
+        # generator over the events start<=i<stop of a binary file as Event
+        # records, see eventRecords
+        for [data,events] in self.iterEventBlocks(filename,start,stop):
+            for event in self.eventRecords(data,events):
+                yield event
+            pass
+        return
+
+
+    def eventRecords(self,data,events):
+        # Event records of a block of events with decoded trailers. The
+        # payload is a memoryview into the block, trailer fields are None
+        # for events with an invalid trailer.
+        view=memoryview(data)
+        for iev in range(len(events["size"])):
+            begin=events["payloadBegin"][iev]
+            payload=view[begin:begin+events["payloadLength"][iev]]
+            if events["validTrailer"][iev]:
+                trailer=[int(events[key][iev]) for key in
+                         ["timestamp","roStatus","trigPhase","nStacked"]]
+            else:
+                trailer=[None,None,None,None]
+                pass
+            yield Event(int(events["index"][iev]),int(events["offset"][iev]),
+                        int(events["eventNumber"][iev]),int(events["size"][iev]),
+                        payload,*trailer)
+            pass
+        return
+
+
+    def iterEventBlocks(self,filename,start=0,stop=None,text=False):
+        # generator over the events start<=i<stop of a binary file (a text
+        # file if text is set) in blocks: yields the bytes of a block and a
+        # dict of per-event arrays (see decodeTrailers). Memory use is
+        # bounded by the block size. With an up to date event index reading
+        # starts at event start and ends at event stop, without it (and
+        # for text files) the file is framed from the beginning.
+        byteStart=0
+        byteLimit=None
+        lastSize=0
+        firstEvent=0
+        index=None
+        if not text:
+            index=self.loadEventIndex(filename)
+            pass
+        if index is not None:
+            if start>0 and start<len(index):
+                byteStart=int(index["offset"][start])
+                lastSize=int(index["size"][start-1])
+                firstEvent=start
+                pass
+            if stop is not None and stop<len(index):
+                byteLimit=int(index["offset"][stop])
+                pass
+            pass
+        nEvents=firstEvent
+        blocks=self.readEventBlocks(filename,byteLimit,byteStart,lastSize,text=text)
+        for [words,events,firstWord,resume] in blocks:
+            events=self.decodeTrailers(words.view(np.uint8),events,firstWord)
+            nBlock=len(events["size"])
+            first=max(start-nEvents,0)
+            last=nBlock
+            if stop is not None:
+                last=min(stop-nEvents,nBlock)
+                pass
+            events["index"]=np.arange(nEvents,nEvents+nBlock)
+            nEvents+=nBlock
+            if first>0 or last<nBlock:
+                for key in events.keys():
+                    if key!="corrupt":
+                        events[key]=events[key][first:max(first,last)]
                         pass
                     pass
-                payloadsize = len(payload)/2
-                if payloadsize in lengthMap.keys():
-                    lengthMap[payloadsize]+=1
+                pass
+            if len(events["size"])>0 or len(events.get("corrupt",[]))>0:
+                yield [words.view(np.uint8),events]
+            if stop is not None and nEvents>=stop:
+                break
+            pass
+        return
+
+
+    def readEventBlocks(self,filename,byteLimit=None,byteStart=0,lastSize=0,
+                        complete=True,text=False):
+        # generator over the complete events of a binary file, read in
+        # blocks of self.blockWords words. Yields the words of each block,
+        # the events framed in it (see frameEvents), the position of the
+        # first word of the block in the file and where to resume reading:
+        # the offset of the unfinished last event and the size to carry
+        # along (None if no further event can be closed). Reading starts at
+        # byteStart and stops at byteLimit, both should be offsets of event
+        # headers, lastSize is the size of the event before byteStart.
+        # Unless complete is set, the end of the file does not close the
+        # last event (for files still being written). With text set the
+        # file holds one hex word per line and is read from the start,
+        # offsets are then counted as 4 bytes per word. With the resync
+        # framing, blocks may hold no events but only corrupt data.
+        datafile=open(filename,"rb")
+        try:
+            datafile.seek(byteStart)
+            carry=np.zeros(0,dtype="<u4")
+            firstWord=byteStart/4
+            wordsRead=firstWord
+            atEnd=False
+            while not atEnd:
+                count=self.blockWords
+                if byteLimit is not None:
+                    count=min(count,byteLimit/4-wordsRead)
+                    pass
+                if text:
+                    chunk=self.readTextWords(datafile,count)
+                else:
+                    chunk=np.fromfile(datafile,dtype="<u4",count=count)
+                    pass
+                wordsRead+=len(chunk)
+                atEnd=len(chunk)<self.blockWords
+                if len(carry)>0:
+                    words=np.concatenate((carry,chunk))
                 else:
-                    lengthMap[payloadsize]=1
+                    words=chunk
                     pass
-                nEvents+=1
-                # Check the max nEvents for DQM
-                if max_nEvents is not None and nEvents > max_nEvents: 
-                    print 'Reaching the max events for DQM: ', max_nEvents 
-                    break 
-                
-                # now get ready for next event
+                if len(words)==0:
+                    break
+                [events,carryStart,lastSize]=self.frameEvents(words,lastSize,
+                                                              atEnd and complete)
+                if carryStart is None:
+                    yield [words,events,firstWord,None]
+                    break
+                yield [words,events,firstWord,[4*(firstWord+carryStart),lastSize]]
+                carry=words[carryStart:]
+                firstWord+=carryStart
+                pass
+        finally:
+            datafile.close()
+            pass
+        return
+
+
+    def readTextWords(self,datafile,count):
+        # read at least count words (unless the file ends) from a text file
+        # with one 8-digit hex word per line, converting them in bulk
+        blocks=[]
+        nWords=0
+        while nWords<count:
+            text=datafile.read(9*(count-nWords))
+            if text=="":
+                break
+            text+=datafile.readline()
+            tokens=text.split()
+            digits="".join(tokens)
+            if len(digits)!=8*len(tokens):
+                raise ValueError("Decoder: text data must have one 8-digit hex word per line")
+            try:
+                block=np.frombuffer(binascii.unhexlify(digits),dtype=">u4").astype("<u4")
+            except TypeError:
+                raise ValueError("Decoder: text data must have one 8-digit hex word per line")
+            blocks.append(block)
+            nWords+=len(block)
+            pass
+        if len(blocks)==0:
+            return np.zeros(0,dtype="<u4")
+        return np.concatenate(blocks)
+
+
+    def eventIndexName(self,filename):
+        # the event index of a file is stored next to it as <name>.idx, as
+        # <name>.ridx for the resync framing
+        if self.resync:
+            return os.path.splitext(filename)[0]+".ridx"
+        return os.path.splitext(filename)[0]+".idx"
+
+
+    def buildEventIndex(self,filename):
+        # byte offset of the header, event number and declared size of
+        # every event in a binary file
+        index=[]
+        for [words,events,firstWord,resume] in self.readEventBlocks(filename):
+            block=np.zeros(len(events["header"]),dtype=eventIndexType)
+            block["offset"]=4*(firstWord+events["header"])
+            block["event"]=events["eventNumber"]
+            block["size"]=events["size"]
+            index.append(block)
+            pass
+        if len(index)==0:
+            return np.zeros(0,dtype=eventIndexType)
+        return np.concatenate(index)
+
+
+    def loadEventIndex(self,filename):
+        # event index stored next to a file, None if there is none or if
+        # the file changed since it was written. The .idx file holds a
+        # small info array (format version, size and modification time of
+        # the data file, number of events) followed by the index itself.
+        try:
+            idxfile=open(self.eventIndexName(filename),"rb")
+        except IOError:
+            return None
+        try:
+            info=np.load(idxfile)
+            stat=os.stat(filename)
+            if len(info)!=4 or info[0]!=eventIndexVersion\
+                   or info[1]!=stat.st_size\
+                   or info[2]!=int(round(stat.st_mtime*1e6)):
+                return None
+            return np.load(idxfile)
+        except (IOError,OSError,ValueError):
+            return None
+        finally:
+            idxfile.close()
+            pass
+
+
+    def eventIndex(self,filename,write=True):
+        # event index of a file, from the .idx file if it is up to date.
+        # Otherwise the index is built and (if possible) saved.
+        index=self.loadEventIndex(filename)
+        if index is not None:
+            return index
+        stat=os.stat(filename)
+        index=self.buildEventIndex(filename)
+        if write:
+            info=np.array([eventIndexVersion,stat.st_size,
+                           int(round(stat.st_mtime*1e6)),len(index)],dtype="<i8")
+            idxname=self.eventIndexName(filename)
+            try:
+                idxfile=open(idxname+".tmp","wb")
+                np.save(idxfile,info)
+                np.save(idxfile,index)
+                idxfile.close()
+                os.rename(idxname+".tmp",idxname)
+            except (IOError,OSError):
+                print "Decoder: could not write event index",idxname
+                pass
+            pass
+        return index
 
+
+    def readEvent(self,filename,ievent,index=None,datafile=None):
+        # words of event number ievent (counting from 0) from its header
+        # up to the next header, using the event index. datafile is the
+        # file already open, if the caller reads several events.
+        if index is None:
+            index=self.eventIndex(filename)
+            pass
+        offset=int(index["offset"][ievent])
+        if datafile is None:
+            eventfile=open(filename,"rb")
+        else:
+            eventfile=datafile
+            pass
+        eventfile.seek(offset)
+        if ievent+1<len(index):
+            count=(int(index["offset"][ievent+1])-offset)/4
+        else:
+            count=-1
+            pass
+        words=np.fromfile(eventfile,dtype="<u4",count=count)
+        if datafile is None:
+            eventfile.close()
+            pass
+        return words
+
+
+    def frameEvents(self,words,lastSize=0,final=True):
+        # split a block of words into events. The first word of the block
+        # opens an event (as the first word of a file did in the word-by-word
+        # decoder), every further ffffffff closes the current event if its
+        # size is known. Returns the event positions (in words), the index
+        # at which the unfinished last event starts (None if no further
+        # event can be closed) and the size to carry along.
+        if self.resync:
+            return self.frameEventsResync(words,lastSize,final)
+        nWords=len(words)
+        markers=np.flatnonzero(words==0xffffffff)
+        if len(markers)==0 or markers[0]!=0:
+            markers=np.concatenate(([0],markers))
+            pass
+        ends=np.append(markers[1:],nWords)
+        segLength=ends-markers-1
+        # event number and size words, sizes of truncated events are
+        # inherited from the previous event
+        numberIndex=np.where(segLength>=1,np.arange(len(markers)),-1)
+        numberIndex=np.maximum.accumulate(numberIndex)
+        evNumber=np.where(numberIndex>=0,
+                          words[np.minimum(markers+1,nWords-1)][np.maximum(numberIndex,0)],
+                          0).astype(np.int64)
+        sizeIndex=np.where(segLength>=2,np.arange(len(markers)),-1)
+        sizeIndex=np.maximum.accumulate(sizeIndex)
+        size=np.where(sizeIndex>=0,
+                      words[np.minimum(markers+2,nWords-1)][np.maximum(sizeIndex,0)],
+                      lastSize).astype(np.int64)
+        nClosed=len(markers)
+        if not final:
+            nClosed-=1
+            pass
+        if np.any(size[:nClosed]==0):
+            # events without size are not closed by the next header,
+            # leave those rare cases to the word-by-word framing
+            return self.frameEventsLoop(words,markers,lastSize,final)
+        events={"header":markers[:nClosed],
+                "eventNumber":evNumber[:nClosed],
+                "size":size[:nClosed],
+                "begin":np.minimum(markers+4,ends)[:nClosed],
+                "end":ends[:nClosed]}
+        if nClosed>0:
+            lastSize=int(size[nClosed-1])
+            pass
+        if final:
+            carryStart=nWords
+        else:
+            carryStart=int(markers[-1])
+            pass
+        return [events,carryStart,lastSize]
+
+
+    def frameEventsLoop(self,words,markers,lastSize=0,final=True):
+        # same as frameEvents, following the state of the word-by-word
+        # decoder from header to header
+        nWords=len(words)
+        header=[]
+        eventNumber=[]
+        size=[]
+        begin=[]
+        end=[]
+        posInEvent=0
+        eventSize=lastSize
+        carrySize=lastSize
+        evNumber=0
+        evHeader=0
+        evBegin=0
+        bounds=list(markers[1:])
+        if final:
+            bounds.append(nWords)
+            pass
+        first=0
+        for bound in bounds:
+            # words from the previous header up to this one
+            nRun=bound-first
+            if posInEvent<=1<posInEvent+nRun:
+                evNumber=int(words[first+1-posInEvent])
+                pass
+            if posInEvent<=2<posInEvent+nRun:
+                eventSize=int(words[first+2-posInEvent])
+                pass
+            if posInEvent<=4<posInEvent+nRun:
+                evBegin=first+4-posInEvent
+                pass
+            posInEvent+=nRun
+            first=bound
+            if eventSize>0:
+                header.append(evHeader)
+                eventNumber.append(evNumber)
+                size.append(eventSize)
+                if posInEvent>4:
+                    begin.append(evBegin)
+                else:
+                    begin.append(bound)
+                    pass
+                end.append(bound)
                 posInEvent=0
-                rocData=""
-            elif posInEvent==1:
-                eventNumber=int(entry,16)
-            elif posInEvent==2:
-                eventSize=int(entry,16)
-            elif posInEvent==3:
-                userHeader=int(entry,16)
-            elif posInEvent>=4:
-                rocData+=entry[6:8]+entry[4:6]+entry[2:4]+entry[0:2]
-            else:
-                pass # this likely only applies to the very first ffffffff header
-            posInEvent+=1
+                evHeader=bound
+                carrySize=eventSize
+                pass
+            pass
+        events={"header":np.array(header,dtype=np.int64),
+                "eventNumber":np.array(eventNumber,dtype=np.int64),
+                "size":np.array(size,dtype=np.int64),
+                "begin":np.array(begin,dtype=np.int64),
+                "end":np.array(end,dtype=np.int64)}
+        if final:
+            carryStart=nWords
+        elif eventSize==0 and posInEvent>2:
+            # the size word has been passed without a size, no later
+            # header can close this event any more
+            carryStart=None
+        else:
+            carryStart=evHeader
+            pass
+        return [events,carryStart,carrySize]
+
+
+    def frameEventsResync(self,words,lastSize=0,final=True):
+        # frameEvents for the resync framing (see setResync). Every
+        # ffffffff with a size from trailerLength to maxEventSize is a
+        # candidate header, valid if no header lies within its padded size,
+        # or if the next header (or the end of the data) follows right after
+        # it and no valid one lies within, and open if this is not known yet
+        # (not final). From the start of the block and after every valid event
+        # the next candidate is taken, with a loop only over the places
+        # where this is not simply the next one. Corrupt data skipped on
+        # the way are returned as [begin,end) word ranges in "corrupt".
+        nWords=len(words)
+        markers=np.flatnonzero(words==0xffffffff)
+        known=markers+2<nWords
+        size=words[np.minimum(markers+2,max(nWords-1,0))].astype(np.int64)
+        end=markers+4+(size+3)/4
+        plausible=known&(size>=self.trailerLength)&(size<=self.maxEventSize)
+        fits=plausible&((end<nWords)|((end==nWords)&final))
+        # events without a header inside are valid, events with one only if
+        # the next header follows and none of those inside is valid
+        nextMarker=np.append(markers[1:],nWords)
+        valid=fits&(end<=nextMarker)
+        nextHeader=words[np.minimum(end,max(nWords-1,0))]==0xffffffff
+        nValid=np.append(0,np.cumsum(valid))
+        validInside=nValid[np.searchsorted(markers,end)]-nValid[1:]
+        valid|=fits&((end==nWords)|nextHeader)&(validInside==0)
+        isOpen=(~final)&((~known)|(plausible&(end>=nWords)))
+        candidates=np.flatnonzero(valid|isOpen)
+        position=markers[candidates]
+        isOpen=isOpen[candidates]
+        successor=np.searchsorted(position,end[candidates])
+        breaks=np.flatnonzero((successor!=np.arange(1,len(candidates)+1))|isOpen)
+        taken=[]
+        carryStart=nWords
+        current=0
+        while current<len(candidates):
+            ibreak=np.searchsorted(breaks,current)
+            if ibreak==len(breaks):
+                taken.append(np.arange(current,len(candidates)))
+                break
+            last=breaks[ibreak]
+            if isOpen[last]:
+                taken.append(np.arange(current,last))
+                carryStart=int(position[last])
+                break
+            taken.append(np.arange(current,last+1))
+            current=successor[last]
+            pass
+        taken=candidates[np.concatenate([np.zeros(0,dtype=np.int64)]+taken)]
+        header=markers[taken]
+        events={"header":header,
+                "eventNumber":words[header+1].astype(np.int64),
+                "size":size[taken],
+                "begin":header+4,
+                "end":end[taken]}
+        gapBegin=np.append(0,end[taken])
+        gapEnd=np.append(header,carryStart)
+        gap=gapEnd>gapBegin
+        events["corrupt"]=np.column_stack((gapBegin[gap],gapEnd[gap]))
+        if len(taken)>0:
+            lastSize=int(size[taken[-1]])
             pass
-        datafile.close()
+        return [events,carryStart,lastSize]
+
+
+    def decodeTrailers(self,data,events,firstWord=0):
+        # add per-event arrays to the events framed in a block of bytes:
+        # byte offset of the header in the file, begin (in the block) and
+        # length of the payload, bytes available up to the next header,
+        # trailer validity and the trailer fields (-1 if invalid)
+        begin=4*events["begin"]
+        size=events["size"]
+        available=4*events["end"]-begin
+        trailerStart=size-self.trailerLength
+        # payload length in bytes, as the string slicing of the word-by-word
+        # decoder
+        payloadLength=np.where(trailerStart>=0,
+                               np.minimum(trailerStart,available),
+                               np.maximum(available+trailerStart,0))
+        validTrailer=(trailerStart>=0)&(available>=size)
+        trailerBegin=np.where(validTrailer,begin+trailerStart,0)
+        trailer=[]
+        for ibyte in range(self.trailerLength):
+            byte=data[np.minimum(trailerBegin+ibyte,len(data)-1)].astype(np.int64)
+            trailer.append(np.where(validTrailer,byte,-1))
+            pass
+        # timestamp (only lowest 32 bits for now)
+        timestamp=np.where(validTrailer,(trailer[8]<<8)+(trailer[9]<<16)
+                           +(trailer[10]<<24)+trailer[12],-1)
+        stackByte=trailer[self.trailerLength-2]
+        statusByte=trailer[self.trailerLength-1]
+        events["offset"]=4*(firstWord+events["header"])
+        events["payloadBegin"]=begin
+        events["payloadLength"]=payloadLength
+        events["available"]=available
+        events["validTrailer"]=validTrailer
+        events["timestamp"]=timestamp
+        events["nStacked"]=np.where(validTrailer,stackByte&0x3f,-1)
+        events["roStatus"]=np.where(validTrailer,statusByte&0x1f,-1)
+        events["trigPhase"]=np.where(validTrailer,(statusByte&0xe0)>>5,-1)
+        if "corrupt" in events:
+            events["corrupt"]=4*(firstWord+events["corrupt"])
+            pass
+        return events
+
+
+    def analyzeEvents(self,data,events,summary):
+        # analyze a block of events with decoded trailers and add them to
+        # summary. data are the bytes of the block, events the arrays from
+        # decodeTrailers.
+        begin=events["payloadBegin"]
+        size=events["size"]
+        available=events["available"]
+        payloadLength=events["payloadLength"]
+        validTrailer=events["validTrailer"]
+        for iev in np.flatnonzero(~validTrailer):
+            # this trailer is invalid.
+            rocData=binascii.hexlify(data[begin[iev]:begin[iev]+available[iev]].tostring())
+            payload=rocData[:2*(size[iev]-self.trailerLength)]
+            trailer=rocData[2*(size[iev]-self.trailerLength):2*size[iev]]
+            print "ERROR: checkDataIntegrity has trailer of"\
+                  +" invalid length:",len(trailer),"digits"
+            print "      ",payload,trailer
+            pass
+        summary.nEvents+=len(size)
+        if "corrupt" in events:
+            summary.fillCorrupt(events["corrupt"])
+            pass
+        # analyze trailers
+        summary.fill("nStacked",events["nStacked"][validTrailer])
+        summary.fill("status",events["roStatus"][validTrailer])
+        summary.fill("trigPhase",events["trigPhase"][validTrailer])
+        summary.fill("length",payloadLength)
+        if self.keepEvents:
+            summary.fillEvents(events)
+            pass
+        # split payloads into ROC headers, pixels and leftovers
+        [headers,leftovers,rocs,pixels,pixelEvents]=self.splitPayloads(data,begin,payloadLength)
+        summary.fill("header",headers)
+        summary.fill("leftover",leftovers)
+        [roc,col,row,pulseheight]=self.decodePixels(rocs,pixels)
+        summary.fill("pulseheight",pulseheight+1)
+        summary.fillPixels(roc,col,row,pulseheight)
+        if self.clustering:
+            hits=self.hitTable(roc,col,row,pulseheight,pixelEvents,np.arange(len(size)))
+            summary.fillClusters(findClusters(hits,summary.nColumns,summary.nRows))
+            pass
+        return
+
+
+    def exportHits(self,filename,prefix,eventsPerChunk=1<<20):
+        # write the valid hits of a binary file as arrays of hitType (event
+        # count in the file, ROC, column, row and pulse height) to files
+        # <prefix>_<n>.npy, with the hits of eventsPerChunk events in each
+        # (see iterHitColumn for reading them back). Returns the names of
+        # the files written.
+        filenames=[]
+        chunk=[]
+        chunkNumber=0
+        for [data,events] in self.iterEventBlocks(filename):
+            if len(events["size"])==0:
+                continue
+            hits=self.eventHits(data,events)
+            while events["index"][-1]>=(chunkNumber+1)*eventsPerChunk:
+                end=np.searchsorted(hits["event"],(chunkNumber+1)*eventsPerChunk)
+                chunk.append(hits[:end])
+                hits=hits[end:]
+                filenames.append(self.saveHitChunk(prefix,chunkNumber,chunk))
+                chunk=[]
+                chunkNumber+=1
+                pass
+            chunk.append(hits)
+            pass
+        if len(chunk)>0:
+            filenames.append(self.saveHitChunk(prefix,chunkNumber,chunk))
+            pass
+        return filenames
+
+
+    def saveHitChunk(self,prefix,chunkNumber,chunk):
+        filename="%s_%04d.npy"%(prefix,chunkNumber)
+        np.save(filename,np.concatenate([np.zeros(0,dtype=hitType)]+chunk))
+        return filename
+
+
+    def eventHits(self,data,events):
+        # valid hits of a block of events with decoded trailers as an array
+        # of hitType, ordered by event
+        [rocs,pixels,pixelEvents]=self.splitPayloads(data,events["payloadBegin"],
+                                                     events["payloadLength"])[2:]
+        [roc,column,row,pulseheight]=self.decodePixels(rocs,pixels)
+        return self.hitTable(roc,column,row,pulseheight,pixelEvents,events["index"])
+
+
+    def hitTable(self,roc,column,row,pulseheight,pixelEvents,eventIndex):
+        # array of hitType of the valid ones of decoded pixels, ordered by
+        # event. pixelEvents are positions in eventIndex.
+        valid=(roc>=0)&(column>=0)&(row>=0)&(pulseheight>=0)
+        order=np.argsort(pixelEvents[valid],kind="mergesort")
+        hits=np.zeros(len(order),dtype=hitType)
+        hits["event"]=eventIndex[pixelEvents[valid][order]]
+        hits["roc"]=roc[valid][order]
+        hits["column"]=column[valid][order]
+        hits["row"]=row[valid][order]
+        hits["pulseheight"]=pulseheight[valid][order]
+        return hits
+
+
+    def splitPayloads(self,data,begin,length):
+        # vectorized version of analyzeOneEvent: all payloads are walked in
+        # parallel in steps of hex digits. Returns headers and leftovers
+        # encoded as (number of digits<<12|value) and (digits<<24|value),
+        # and the ROC index, 24-bit word and event (position in begin) of
+        # every pixel.
+        nData=len(data)
+        headers=[]
+        leftovers=[]
+        rocs=[]
+        pixels=[]
+        pixelEvents=[]
+        active=np.flatnonzero(length>0)
+        digit=2*begin[active]
+        lastDigit=digit+2*length[active]
+        nHeaders=np.zeros(len(active),dtype=np.int64)
+        while len(active)>0:
+            remaining=lastDigit-digit
+            # the 8 hex digits starting at the (even) digit before
+            first=digit>>1
+            word=np.zeros(len(first),dtype=np.int64)
+            for ibyte in range(4):
+                word=(word<<8)|data[np.minimum(first+ibyte,nData-1)]
+                pass
+            shift=32-4*(digit&1)
+            isHeader=(remaining>=2)&(((word>>(shift-8))&0xff)==0x7f)
+            isPixel=(~isHeader)&(remaining>=6)
+            isLeftover=(~isHeader)&(~isPixel)
+            nDigits=np.minimum(remaining,3)[isHeader]
+            value=(word[isHeader]>>(shift[isHeader]-4*nDigits))&((1<<(4*nDigits))-1)
+            headers.append((nDigits<<12)|value)
+            value=(word[isPixel]>>(shift[isPixel]-24))&0xffffff
+            rocs.append(nHeaders[isPixel])
+            pixels.append(value)
+            pixelEvents.append(active[isPixel])
+            nDigits=remaining[isLeftover]
+            value=(word[isLeftover]>>(shift[isLeftover]-4*nDigits))&((1<<(4*nDigits))-1)
+            leftovers.append((nDigits<<24)|value)
+            nHeaders+=isHeader
+            digit+=np.where(isHeader,3,6)
+            more=digit<lastDigit
+            active=active[more]
+            digit=digit[more]
+            lastDigit=lastDigit[more]
+            nHeaders=nHeaders[more]
+            pass
+        empty=np.zeros(0,dtype=np.int64)
+        return [np.concatenate([empty]+headers),np.concatenate([empty]+leftovers),
+                np.concatenate([empty]+rocs),np.concatenate([empty]+pixels),
+                np.concatenate([empty]+pixelEvents)]
+
+
+    def decodePixels(self,rocs,pixels):
+        # batch version of pixelDecoder for arrays of ROC indices and raw
+        # 24-bit pixel words, returns arrays of roc, column, row and
+        # pulse height with -1 for invalid fields
+        rocs=np.asarray(rocs,dtype=np.int64)
+        pixels=np.asarray(pixels,dtype=np.int64)&0xffffff
+        column=self.columnArray[((pixels>>17)&0x7e)|((pixels>>9)&1)]
+        row=self.rowArray[(pixels>>9)&0x1ff]
+        pulseheight=self.pulseheightArray[pixels&0x1ff]
+        # ROC numbers beyond one digit were never decoded
+        badRoc=rocs>9
+        return [np.where(badRoc,-1,rocs),np.where(badRoc,-1,column),
+                np.where(badRoc,-1,row),np.where(badRoc,-1,pulseheight)]
+
+
+    def printSummary(self,summary):
+        nEvents=summary.nEvents
         print "summary: total number of events was",nEvents
         #print "         average number of pixels per event was", (nEvents
         if nEvents>0:
-            nheaders=0
+            headerMap=summary.headerMap()
             keys=headerMap.keys()
             keys.sort()
             for entry in keys:
                 print "         header",entry,":",headerMap[entry]
-                nheaders+=headerMap[entry]
                 pass
-            print "fraction of missing headers (assuming",self.numROCs,"ROCs):",\
-                  (self.numROCs*nEvents-nheaders)*1.0/self.numROCs/nEvents
+            print "fraction of missing headers (assuming",summary.numROCs,"ROCs):",\
+                  summary.missingHeaderFraction()
             pass
+        leftoverMap=summary.leftoverMap()
         keys=leftoverMap.keys()
         keys.sort()
         for entry in keys:
             print "         extra",entry,"between ROCs and trailer:",leftoverMap[entry]
             pass
-        keys=lengthMap.keys()
-        keys.sort()
-        #for entry in keys:
-        #    print "         length",entry,":",lengthMap[entry]
-        #    pass
-        badhits=0
-        unexpectedhits=0
-        nhits=0
-        keys=pixelMap.keys()
-        keys.sort()
-        for entry in keys:
-            pixel=self.pixelDecoder(entry)
-            #print "         pixel",entry,pixel,":",pixelMap[entry]
-            nhits+=pixelMap[entry]
-            if (pixel[0]<0) or (pixel[1]<0) or (pixel[2]<0) or (pixel[3]<0):
-                badhits+=pixelMap[entry]
-            elif (not pixel[0] in self.allExpectedRocNums) or\
-                     (not pixel[1] in self.allExpectedColumns) or\
-                     (not pixel[2] in self.allExpectedRows):
-                unexpectedhits+=pixelMap[entry]
+        if (summary.nHits>0):
+            print "fraction of invalid hits:",summary.invalidHitFraction()
+            pass
+        if summary.expected is not None:
+            print "fraction of expected hits:",summary.expectedHitFraction()
+            print "fraction of unexpected hits:",summary.unexpectedHitFraction()
+            print "mean efficiency of armed pixels:",summary.meanEfficiency()
+            pass
+        if summary.sampledFraction<1:
+            print "fraction of events sampled:",summary.sampledFraction
+            pass
+        if len(summary.corruptRanges)>0:
+            print "corrupt data skipped:",summary.corruptBytes(),"bytes in",\
+                  len(summary.corruptRanges),"ranges"
+            for [begin,end] in summary.corruptRanges[:10]:
+                print "         bytes",begin,"to",end
                 pass
             pass
-        if (nhits>0):
-            print "fraction of invalid hits:",1.0*badhits/nhits
-            # only make sense in the calibration mode 
-            #print "fraction of unexpected hits:",1.0*unexpectedhits/nhits
-
+        nClusters=summary.clusterSize.sum(axis=1)
+        meanClusterSize=summary.meanClusterSize()
+        for roc in np.flatnonzero(nClusters):
+            print "         ROC",roc+1,"clusters:",nClusters[roc],\
+                  "mean size:",meanClusterSize[roc]
             pass
-        keys=pulseheightMap.keys()
-        keys.sort()
-        #for entry in keys:
-        #    print "         pulseheight",entry,":",pulseheightMap[entry]
-        #    pass
-        keys=trigPhaseMap.keys()
-        keys.sort()
-        for entry in keys:
-            print "         trigger phase",entry,":",trigPhaseMap[entry]
+        for entry in np.flatnonzero(summary.trigPhase):
+            print "         trigger phase",entry,":",summary.trigPhase[entry]
             pass
-        keys=nStackedMap.keys()
-        keys.sort()
-        for entry in keys:
-            print "         events with",entry,"triggers stacked:",nStackedMap[entry]
+        for entry in np.flatnonzero(summary.nStacked):
+            print "         events with",entry,"triggers stacked:",summary.nStacked[entry]
             pass
-        keys=statusMap.keys()
-        keys.sort()
-        for entry in keys:
-            print "         event status",entry,":",statusMap[entry]
+        for entry in np.flatnonzero(summary.status):
+            print "         event status",entry,":",summary.status[entry]
             pass
         return
 
 
     def decodeEventString(self,eventString):
-        return
+        # decode one event given as hex words (as for printEventString)
+        # into an Event record, None if there is no complete event
+        words=np.array([int(word,16) for word in eventString.split()],dtype="<u4")
+        if len(words)==0:
+            return None
+        [events,carryStart,lastSize]=self.frameEvents(words)
+        events=self.decodeTrailers(words.view(np.uint8),events)
+        events["index"]=np.arange(len(events["size"]))
+        for event in self.eventRecords(words.view(np.uint8),events):
+            return event
+        return None
             
 
     def decodeDataFile(self,filename):
-        return
-
-    
+        # all events of a binary file as Event records
+        return self.iterEvents(filename)
@@ -0,0 +1,184 @@
+#!/usr/bin/env python
+"""
+Benchmark the raw data decoder on synthetic files of several sizes and
+save the results as JSON, so that releases can be compared
+
+"""
+
+import sys
+import os
+import time
+import json
+import shutil
+import socket
+import resource
+import tempfile
+import traceback
+import multiprocessing
+from optparse import OptionParser
+
+import numpy as np
+
+import Decoder_dqm
+import gendat
+
+
+def main():
+    parser = OptionParser(usage="usage: %prog [options]")
+    parser.add_option("-n", "--nevents",
+                        action="store",
+                        dest="nevents",
+                        default="1000,10000,100000",
+                        help="Numbers of events of the files. Comma separated list")
+    parser.add_option("-r", "--rocs",
+                        action="store",
+                        dest="rocs",
+                        default=8,
+                        help="Number of ROCs")
+    parser.add_option("-p", "--hits",
+                        action="store",
+                        dest="hits",
+                        default=2.0,
+                        help="Mean number of hits per ROC and event")
+    parser.add_option("-w", "--workers",
+                        action="store",
+                        dest="workers",
+                        default=1,
+                        help="Number of decoder processes")
+    parser.add_option("-o", "--output",
+                        action="store",
+                        dest="output",
+                        default="bench_decoder.json",
+                        help="File for the results")
+    parser.add_option("-d", "--data_dir",
+                        action="store",
+                        dest="data_dir",
+                        default=None,
+                        help="Keep the generated files in this directory")
+    (options, args) = parser.parse_args()
+
+    nevents = [int(n) for n in options.nevents.split(',')]
+    results = run_benchmarks(nevents, int(options.rocs), float(options.hits),
+                             int(options.workers), options.data_dir)
+    save_results(results, options.output)
+    for result in results['benchmarks']:
+        sys.stdout.write('[bench_decoder] %-20s %9s events %10.0f events/s '
+                         '%8.2f MB/s %8.1f MB RSS %8.1f MB RSS/worker\n'
+                         % (result['name'], result['events'],
+                            result['events_per_sec'], result['mb_per_sec'],
+                            result['max_rss_mb'], result['max_rss_workers_mb']))
+    sys.stdout.write('[bench_decoder] results saved in %s\n' % options.output)
+
+
+def run_benchmarks(nevents, nrocs=8, hits=2.0, workers=1, data_dir=None):
+    # generate a file for each number of events and time the decoder on
+    # it. Every measurement runs in its own process, so that its peak RSS
+    # is not mixed up with the others.
+    tmpdir = None
+    if data_dir is None:
+        tmpdir = tempfile.mkdtemp(prefix='bench_decoder')
+        data_dir = tmpdir
+    benchmarks = []
+    try:
+        for n in nevents:
+            filename = os.path.join(data_dir, 'bench_%s.dat' % n)
+            if not os.path.exists(filename):
+                gendat.write_dat_file(filename, n, nrocs, hits, seed=n)
+            for name in ['checkDataIntegrity', 'pixelDecoder', 'analyzeOneEvent']:
+                benchmarks.append(run_in_process(name, filename, workers))
+    finally:
+        if tmpdir is not None:
+            shutil.rmtree(tmpdir)
+    return {'host': socket.gethostname(),
+            'date': time.strftime('%Y-%m-%d %H:%M:%S'),
+            'python': sys.version.split()[0],
+            'numpy': np.__version__,
+            'nrocs': nrocs,
+            'hits': hits,
+            'workers': workers,
+            'benchmarks': benchmarks}
+
+
+def save_results(results, filename):
+    f = open(filename, 'w')
+    json.dump(results, f, indent=1, sort_keys=True)
+    f.close()
+
+
+def run_in_process(name, filename, workers=1):
+    # a plain process rather than a pool, which could not start the
+    # decoder workers of its own
+    queue = multiprocessing.Queue()
+    process = multiprocessing.Process(target=queue_benchmark,
+                                      args=(queue, name, filename, workers))
+    process.start()
+    result = queue.get()
+    process.join()
+    if isinstance(result, str):
+        raise RuntimeError('benchmark %s failed:\n%s' % (name, result))
+    return result
+
+
+def queue_benchmark(queue, name, filename, workers=1):
+    try:
+        queue.put(run_benchmark(name, filename, workers))
+    except:
+        queue.put(traceback.format_exc())
+        raise
+
+
+def run_benchmark(name, filename, workers=1):
+    # time one decoder function on a file: checkDataIntegrity on the whole
+    # file, pixelDecoder on all its pixels and analyzeOneEvent on all its
+    # payloads (the last two as hex strings prepared beforehand). Calls
+    # counts the pixels or events the function was called for. The peak
+    # RSS of the decoder worker processes (with workers > 1) is reported
+    # separately, as the largest of them.
+    decoder = Decoder_dqm.Decoder()
+    decoder.setNumWorkers(workers)
+    nbytes = os.path.getsize(filename)
+    if name == 'checkDataIntegrity':
+        stdout = sys.stdout
+        sys.stdout = open(os.devnull, 'w')
+        try:
+            start = time.time()
+            summary = decoder.checkDataIntegrity(filename, 1)
+            seconds = time.time() - start
+        finally:
+            sys.stdout.close()
+            sys.stdout = stdout
+        nevents = summary.nEvents
+        calls = 1
+    else:
+        payloads = [event.payload.tobytes().encode('hex')
+                    for event in decoder.iterEvents(filename)]
+        nevents = len(payloads)
+        if name == 'pixelDecoder':
+            pixels = []
+            for payload in payloads:
+                pixels.extend(decoder.analyzeOneEvent(payload)[2])
+            calls = len(pixels)
+            start = time.time()
+            for pixel in pixels:
+                decoder.pixelDecoder(pixel)
+            seconds = time.time() - start
+        else:
+            calls = nevents
+            start = time.time()
+            for payload in payloads:
+                decoder.analyzeOneEvent(payload)
+            seconds = time.time() - start
+    seconds = max(seconds, 1e-9)
+    return {'name': name,
+            'file_bytes': nbytes,
+            'events': nevents,
+            'calls': calls,
+            'seconds': seconds,
+            'events_per_sec': nevents / seconds,
+            'mb_per_sec': nbytes / seconds / 1e6,
+            'max_rss_mb': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.,
+            'max_rss_workers_mb': resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss / 1024.}
+
+
+if __name__ == '__main__':
+    main()
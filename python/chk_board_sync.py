@@ -0,0 +1,40 @@
+#!/usr/bin/env python
+"""
+Check that the binary data files of two boards (PixelTestBoard1/2) of a
+run recorded the same triggers
+
+"""
+
+import sys
+from optparse import OptionParser
+
+import Decoder_dqm
+
+
+def main():
+    parser = OptionParser(usage="usage: %prog [options] datfile1 datfile2")
+    parser.add_option("-d", "--max_drift",
+                        action="store",
+                        dest="max_drift",
+                        default=0,
+                        help="Allowed timestamp drift between the boards")
+    parser.add_option("-l", "--max_listed",
+                        action="store",
+                        dest="max_listed",
+                        default=100,
+                        help="Number of missing and extra events listed")
+    (options, args) = parser.parse_args()
+
+    if len(args) < 2:
+        parser.error("Too few arguments")
+
+    decoder = Decoder_dqm.Decoder()
+    report = decoder.checkBoardSync(args[0], args[1], int(options.max_drift),
+                                    int(options.max_listed))
+    decoder.printBoardSync(report)
+    if report['firstDesync'] is not None:
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -4,6 +4,7 @@ debug = False
 #Global variables specific to testbeam setup
 dataset='FNAL2014'
 dbdir = '/afs/cern.ch/cms/Tracker/Pixel/HRbeamtest/data/'+dataset+'/.db/'
+catalog_file = dbdir+'catalog.pkl'
 dqm_env_file = '/afs/cern.ch/cms/Tracker/Pixel/HRbeamtest/dqm/fnal201403/setup.sh'
 
 #eos command
@@ -25,6 +26,11 @@ submit_dir = '/afs/cern.ch/cms/Tracker/Pixel/HRbeamtest/batch'
 #publish settings
 default_publish_dir = '/tmp/tracktb/publish'
 
+#node-local cache of files staged from eos
+cache_dir = '/tmp/tracktb/cache'
+cache_budget = 20 << 30 # bytes
+env_cache_dir = '/tmp/tracktb/env' # environments of source_bash
+
 #Small class for organizing status information, status should proceed through each value as it goes along
 class STATUS:
 	  failed, unknown, submitted, returned, published, nStatus = range(-2,4)
@@ -20,6 +20,7 @@ import utils
 import process
 import publish
 import index
+import watch
 
 import logging
 #LOGNAME = 'dqm-%s%s.log' % (os.getenv('HOSTNAME'), os.getenv('STY',''))
@@ -37,6 +38,7 @@ log = logging.getLogger("dqm")
 max_submissions = 5
 begin_valid_run = 175700
 loop_back = 100
+rescan_interval = 60 # seconds between full passes of the loops while nothing changes
 
 def main():
     parser = OptionParser(usage="usage: %prog [options]")
@@ -98,6 +100,9 @@ def default(eos_mounted=False, batch=False):
     # if debug:
     #     sys.stdout.write('Getting runs\n')
     runs = utils.get_runs(eos_mounted)
+    catalog = utils.load_catalog()
+    utils.update_catalog(catalog, runs, eos_mounted, begin_valid_run)
+    utils.save_catalog(catalog)
     runs = sorted(runs, reverse=True)
     log.info('Got %s runs', len(runs))
     # sys.stdout.write('Got %s runs\n' % len(runs))
@@ -106,7 +111,7 @@ def default(eos_mounted=False, batch=False):
     for run in runs:
         if run < begin_valid_run:
             break
-        datfile = utils.get_datfile_names(run, eos_mounted)
+        datfile = utils.catalog_datfile_names(catalog, run)
         if not datfile:
             log.debug('No dat file for run %s', run)
             # if debug: 
@@ -159,23 +164,20 @@ def loop_processing(eos_mounted=False, batch=False):
     submissions = 0 #counter for how many jobs we've submitted
     restart = False #restart at newewt runs after processing
 
+    catalog = utils.load_catalog()
+    watcher = start_watcher(eos_mounted)
+    events = None
     try:
         while True:
             restart = False
-            log.info('Sleeping for just a second. Now would be a good time to interrupt')
-            # sys.stdout.write('Sleeping for just a second. Now would be a good time to interrupt\n')
-            # sys.stdout.flush()
-            time.sleep(1)
+            if watcher is None:
+                log.info('Sleeping for just a second. Now would be a good time to interrupt')
+                # sys.stdout.write('Sleeping for just a second. Now would be a good time to interrupt\n')
+                # sys.stdout.flush()
+                time.sleep(1)
 
-            runs = utils.get_runs(eos_mounted)
-            runs = sorted(runs, reverse=True)
-            try:
-                latest_run = runs[0]
-            except IndexError:
-                log.error('List index out of range?! No runs?! runs: %s', runs)
-
-            log.info('Got %s runs', len(runs))
-            # sys.stdout.write('Got %s runs\n' % len(runs))
+            runs = get_loop_runs(catalog, eos_mounted, events)
+            latest_run = catalog['high_water']
 
             #loop over all the runs we found
             for run in runs:
@@ -183,7 +185,7 @@ def loop_processing(eos_mounted=False, batch=False):
                     break
                 if run < latest_run - loop_back: #begin_valid_run:
                     break
-                datfile = utils.get_datfile_names(run, eos_mounted)
+                datfile = utils.catalog_datfile_names(catalog, run)
                 if not datfile:
                     log.debug('No dat file for run %s', run)
                     # if debug: 
@@ -209,6 +211,11 @@ def loop_processing(eos_mounted=False, batch=False):
                             if batch:
                                 break
 
+            #nothing submitted: wait for new data or job statuses
+            events = None
+            if watcher is not None and not restart:
+                events = wait_for_changes(watcher)
+
     except KeyboardInterrupt:
         log.warning('Processing Interrupted')
         # sys.stdout.write('ProcessingInterrupted\n')
@@ -228,23 +235,20 @@ def loop_publishing(eos_mounted=False, batch=False):
     submissions = 0 #counter for how many jobs we've submitted
     restart = 5 #restart at newest runs after publishing some runs
 
+    catalog = utils.load_catalog()
+    watcher = start_watcher(eos_mounted)
+    events = None
     try:
         while True:
             restart = 3
-            log.info('Sleeping for just a second. Now would be a good time to interrupt')
-            # sys.stdout.write('Sleeping for just a second. Now would be a good time to interrupt\n')
-            # sys.stdout.flush()
-            time.sleep(1)
+            if watcher is None:
+                log.info('Sleeping for just a second. Now would be a good time to interrupt')
+                # sys.stdout.write('Sleeping for just a second. Now would be a good time to interrupt\n')
+                # sys.stdout.flush()
+                time.sleep(1)
 
-            runs = utils.get_runs(eos_mounted)
-            runs = sorted(runs, reverse=True)
-            try:
-                latest_run = runs[0]
-            except IndexError:
-                log.error('List index out of range?! No runs?! runs: %s', runs)
-
-            log.info('Got %s runs', len(runs))
-            # sys.stdout.write('Got %s runs\n' % len(runs))
+            runs = get_loop_runs(catalog, eos_mounted, events)
+            latest_run = catalog['high_water']
 
             #loop over all the runs we found
             for run in runs:
@@ -252,7 +256,7 @@ def loop_publishing(eos_mounted=False, batch=False):
                     break
                 if run < latest_run - loop_back: #begin_valid_run:
                     break
-                datfile = utils.get_datfile_names(run, eos_mounted)
+                datfile = utils.catalog_datfile_names(catalog, run)
                 if not datfile:
                     log.debug('No dat file for run %s', run)
                     # if debug: 
@@ -282,6 +286,11 @@ def loop_publishing(eos_mounted=False, batch=False):
                         else:
                             break #if this job's not returned, other one can't be either
 
+            #went through all runs: wait for returned jobs or new data
+            events = None
+            if watcher is not None and restart > 0:
+                events = wait_for_changes(watcher)
+
     except KeyboardInterrupt:
         log.warning('Publishing Interrupted')
         # sys.stdout.write('Publishing Interrupted\n')
@@ -294,6 +303,50 @@ def loop_publishing(eos_mounted=False, batch=False):
     # sys.stdout.write('Published %s jobs\n' % submissions)
 
 
+def start_watcher(eos_mounted=False):
+    #on the mounted eos, wait for new data and job statuses instead of
+    #listing everything every second. The files are written by the DAQ
+    #hosts and the batch jobs, so poll rather than use inotify
+    if not eos_mounted:
+        return None
+    return watch.RunWatcher(utils.daqdir, nruns=loop_back, use_inotify=False,
+                            dbdir=dbdir)
+
+def wait_for_changes(watcher):
+    #the watch.WatchEvents of the next changes, None if there were none
+    #for rescan_interval seconds, which asks for a full pass
+    log.info('Waiting for changes. Now would be a good time to interrupt')
+    events = watcher.wait(rescan_interval)
+    log.info('%s changes in the data and db directories', len(events))
+    if not events:
+        return None
+    return events
+
+def get_loop_runs(catalog, eos_mounted=False, events=None):
+    #the runs to go through, newest first, with the catalog updated: all
+    #runs if events is None, otherwise only those the events are about
+    if events is not None:
+        runs = set(event.run for event in events if event.run is not None)
+        utils.relist_runs(catalog, runs, eos_mounted)
+        utils.save_catalog(catalog)
+        log.info('Changes in %s runs', len(runs))
+        return sorted(runs, reverse=True)
+
+    runs = utils.get_runs(eos_mounted)
+    runs = sorted(runs, reverse=True)
+    try:
+        latest_run = runs[0]
+    except IndexError:
+        log.error('List index out of range?! No runs?! runs: %s', runs)
+    else:
+        utils.update_catalog(catalog, runs, eos_mounted, latest_run - loop_back)
+        utils.save_catalog(catalog)
+
+    log.info('Got %s runs', len(runs))
+    # sys.stdout.write('Got %s runs\n' % len(runs))
+    return runs
+
+
 ####
 
 def process_job(job, filename, eos_mounted=False, batch=False):
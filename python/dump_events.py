@@ -0,0 +1,64 @@
+#!/usr/bin/env python
+"""
+Dump selected events of a binary raw data file as formatted hex
+
+"""
+
+import sys
+from optparse import OptionParser
+
+import Decoder_dqm
+
+
+def main():
+    parser = OptionParser(usage="usage: %prog [options] filename")
+    parser.add_option("-r", "--range",
+                        action="store",
+                        dest="range",
+                        default=None,
+                        help="Range of event numbers, e.g. 100-200")
+    parser.add_option("-e", "--events",
+                        action="store",
+                        dest="events",
+                        default=None,
+                        help="Event numbers. Comma separated list")
+    parser.add_option("-o", "--output",
+                        action="store",
+                        dest="output",
+                        default=None,
+                        help="Output file (default: standard output)")
+    (options, args) = parser.parse_args()
+
+    if len(args) < 1:
+        parser.error("Too few arguments")
+
+    first = None
+    last = None
+    if options.range is not None:
+        first, last = parse_range(options.range)
+    numbers = None
+    if options.events is not None:
+        numbers = [int(n) for n in options.events.split(',')]
+
+    output = sys.stdout
+    if options.output is not None:
+        output = open(options.output, 'w')
+    try:
+        Decoder_dqm.Decoder().dumpEvents(args[0], output, first, last, numbers)
+    finally:
+        if output is not sys.stdout:
+            output.close()
+
+
+def parse_range(val):
+    # 'first-last', 'first-' or 'number'
+    if '-' not in val:
+        return int(val), int(val)
+    first, last = val.split('-')
+    if last == '':
+        return int(first), None
+    return int(first), int(last)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,149 @@
+#!/usr/bin/env python
+"""
+Write synthetic raw data files (.dat) in the test board format, for
+testing and benchmarking the decoder
+
+"""
+
+import sys
+import struct
+import random
+import binascii
+from optparse import OptionParser
+
+import Decoder_dqm
+
+
+def main():
+    parser = OptionParser(usage="usage: %prog [options] filename nevents")
+    parser.add_option("-r", "--rocs",
+                        action="store",
+                        dest="rocs",
+                        default=8,
+                        help="Number of ROCs")
+    parser.add_option("-p", "--hits",
+                        action="store",
+                        dest="hits",
+                        default=2.0,
+                        help="Mean number of hits per ROC and event")
+    parser.add_option("-n", "--noise",
+                        action="store",
+                        dest="noise",
+                        default=0.0,
+                        help="Fraction of hits with random pixel words")
+    parser.add_option("-c", "--corrupt",
+                        action="store",
+                        dest="corrupt",
+                        default=0.0,
+                        help="Fraction of events with a corrupt trailer")
+    parser.add_option("-t", "--roc_type",
+                        action="store",
+                        dest="roc_type",
+                        default=0,
+                        help="ROC version as for Decoder.setROCVersion")
+    parser.add_option("-s", "--seed",
+                        action="store",
+                        dest="seed",
+                        default=None,
+                        help="Seed of the random numbers")
+    (options, args) = parser.parse_args()
+
+    if len(args) < 2:
+        parser.error("Too few arguments")
+
+    seed = options.seed
+    if seed is not None:
+        seed = int(seed)
+    nbytes = write_dat_file(args[0], int(args[1]), int(options.rocs),
+                            float(options.hits), float(options.noise),
+                            float(options.corrupt), int(options.roc_type), seed)
+    sys.stdout.write('[gendat] %s: %s events, %s bytes\n'
+                     % (args[0], args[1], nbytes))
+
+
+def pixel_encoding(roc_type=0):
+    # tables from (column, row) and from pulse height to the bits of a
+    # 24-bit pixel word, inverting the lookup tables of the decoder
+    decoder = Decoder_dqm.Decoder()
+    decoder.rocType = roc_type
+    decoder.buildPixelTables()
+    address = {}
+    for bits in range(1 << 15):
+        value = bits << 9
+        column = decoder.columnTable[((value >> 17) & 0x7e) | ((value >> 9) & 1)]
+        row = decoder.rowTable[(value >> 9) & 0x1ff]
+        if column >= 0 and row >= 0 and (column, row) not in address:
+            address[(column, row)] = value
+    pulseheight = {}
+    for bits in range(512):
+        ph = decoder.pulseheightTable[bits]
+        if ph >= 0 and ph not in pulseheight:
+            pulseheight[ph] = bits
+    return address, pulseheight
+
+
+def event_payload(rnd, address, pulseheight, nrocs, hits, noise):
+    # hex digits of the ROC headers and pixels of one event
+    digits = []
+    for roc in range(nrocs):
+        digits.append('7f%x' % rnd.randint(0, 15))
+        nhits = 0
+        # poisson distributed number of hits
+        limit = rnd.expovariate(1.0)
+        while limit < hits:
+            nhits += 1
+            limit += rnd.expovariate(1.0)
+        for hit in range(nhits):
+            if rnd.random() < noise:
+                value = rnd.getrandbits(24)
+            else:
+                value = address[(rnd.randint(0, 51), rnd.randint(0, 79))] \
+                        | pulseheight[rnd.randint(0, 255)]
+            digits.append('%06x' % value)
+    payload = ''.join(digits)
+    if len(payload) % 2:
+        payload += '0'
+    return binascii.unhexlify(payload)
+
+
+def event_trailer(rnd, timestamp):
+    # 15-byte trailer: timestamp in bytes 8-10 and 12, number of stacked
+    # triggers in byte 13, readout status and trigger phase in byte 14
+    trailer = bytearray(15)
+    trailer[8] = (timestamp >> 8) & 0xff
+    trailer[9] = (timestamp >> 16) & 0xff
+    trailer[10] = (timestamp >> 24) & 0xff
+    trailer[12] = timestamp & 0xff
+    trailer[13] = rnd.randint(0, 3)
+    trailer[14] = rnd.randint(0, 7) << 5
+    return str(trailer)
+
+
+def write_dat_file(filename, nevents, nrocs=8, hits=2.0, noise=0.0,
+                   corrupt=0.0, roc_type=0, seed=None):
+    # write nevents events: header word ffffffff, event number, size in
+    # bytes, user header and the payload and trailer bytes padded to full
+    # words. Events with a corrupt trailer declare more bytes than they
+    # have. Returns the number of bytes written.
+    rnd = random.Random(seed)
+    address, pulseheight = pixel_encoding(roc_type)
+    timestamp = 0
+    nbytes = 0
+    f = open(filename, 'wb')
+    for event in range(nevents):
+        timestamp += rnd.randint(1, 1000)
+        body = event_payload(rnd, address, pulseheight, nrocs, hits, noise) \
+               + event_trailer(rnd, timestamp & 0xffffffff)
+        size = len(body)
+        body += '\0' * (-len(body) % 4)
+        if rnd.random() < corrupt:
+            size = len(body) + rnd.randint(1, 14)
+        record = struct.pack('<IIII', 0xffffffff, event & 0xffffffff, size, 0) + body
+        f.write(record)
+        nbytes += len(record)
+    f.close()
+    return nbytes
+
+
+if __name__ == '__main__':
+    main()
@@ -281,6 +281,7 @@ def copy_to_eos(workdir, eos_out, run, board):
 
     outputdirs = [ 'databases', 'histograms', 'lcio', 'logs']
 
+    transfers = []
     for outdir in outputdirs:
         from_dir = os.path.join(workdir,outdir)
         to_dir = os.path.join(eos_out,board,outdir)
@@ -288,8 +289,11 @@ def copy_to_eos(workdir, eos_out, run, board):
         output = utils.proc_cmd(cmd)
         for line in output.split():
             if line.startswith(str(run).zfill(6)):
-                cmd = 'xrdcp -f %s/%s root://eoscms//%s/%s' % (from_dir, line, to_dir, line)
-                utils.proc_cmd(cmd)
+                transfers.append((os.path.join(from_dir, line),
+                                  utils.xrootd_prefix + os.path.join(to_dir, line)))
+    results = utils.transfer_files(transfers)
+    utils.cache_files(results)
+    return results
 
 #copy any slcio files we might need
 def copy_from_eos(workdir, eos_out, run, board):
@@ -301,19 +305,19 @@ def copy_from_eos(workdir, eos_out, run, board):
     slcio_databases = ['prealignment', 'reference']
     slcio_lcio = ['convert', 'clustering', 'hitmaker']
 
+    transfers = []
     for slcio in slcio_databases:
         slcioname = str(run).zfill(6) + '-' + slcio + '.slcio'
         from_file = os.path.join(eos_out, board, 'databases', slcioname)
         to_dir = os.path.join(workdir,'databases')
-        cmd = 'xrdcp -f root://eoscms//%s %s/' % (from_file, to_dir)
-        utils.proc_cmd(cmd)
+        transfers.append((utils.xrootd_prefix + from_file, os.path.join(to_dir, slcioname)))
 
     for slcio in slcio_lcio:
         slcioname = str(run).zfill(6) + '-' + slcio + '.slcio'
         from_file = os.path.join(eos_out, board, 'lcio', slcioname)
         to_dir = os.path.join(workdir,'lcio')
-        cmd = 'xrdcp -f root://eoscms//%s %s/' % (from_file, to_dir)
-        utils.proc_cmd(cmd)
+        transfers.append((utils.xrootd_prefix + from_file, os.path.join(to_dir, slcioname)))
+    return utils.fetch_files(transfers)
 
 def process_batch(datfile, modes, 
                     workingdir=default_work_dir, cfgfile=job_config_file, nevents=999999999, 
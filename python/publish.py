@@ -95,19 +95,19 @@ def copy_from_eos(workdir, eos_out, run, board):
     if not os.path.exists(subdir):
         os.makedirs(subdir)
 
+    transfers = []
     for name in rootfilenames:
         filename = str(run).zfill(6) + '-' + name + '.root'
         from_file = os.path.join(eos_out, board, 'histograms', filename)
         to_dir = os.path.join(workdir,'histograms')
-        cmd = 'xrdcp -f root://eoscms//%s %s/' % (from_file, to_dir)
-        utils.proc_cmd(cmd)
+        transfers.append((utils.xrootd_prefix + from_file, os.path.join(to_dir, filename)))
 
     for name in lciofilenames:
         filename = str(run).zfill(6) + '-' + name
         from_file = os.path.join(eos_out, board, 'lcio', filename)
         to_dir = os.path.join(workdir,'lcio')
-        cmd = 'xrdcp -f root://eoscms//%s %s/' % (from_file, to_dir)
-        utils.proc_cmd(cmd)
+        transfers.append((utils.xrootd_prefix + from_file, os.path.join(to_dir, filename)))
+    return utils.fetch_files(transfers)
 
 def clean_working_directory(myDir, run):
     log.debug('Cleaning %s of files for run %s', myDir, str(run))
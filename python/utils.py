@@ -2,6 +2,13 @@
 import sys
 import os
 import subprocess
+import signal
+import threading
+import time
+import Queue
+import cPickle
+import hashlib
+import re
 #from datetime import datetime
 
 import logging
@@ -10,6 +17,20 @@ log = logging.getLogger(__name__)
 from config import *
 
 default_mount_point = '/tmp/tracktb'
+eos_timeout = 300 # seconds before an eos listing is given up
+
+# commands run by run_cmd at the same time, and bytes of output kept
+max_cmds = 8
+max_output = 1 << 24
+kill_grace = 5 # seconds to wait for the output of a killed command
+cmd_slots = threading.BoundedSemaphore(max_cmds)
+
+# xrdcp transfers, see transfer_files
+xrootd_prefix = 'root://eoscms//'
+transfer_workers = 4
+transfer_retries = 3
+transfer_backoff = 10 # seconds before the first retry, doubled for each further one
+transfer_timeout = 3600
 
 
 
@@ -46,7 +67,8 @@ def get_runs(eos_mounted=True):
     cmd = 'ls -1 %s' % daqdir
     if not eos_mounted:
         cmd = '%s ls %s' % (eos, daqdir)
-    output = proc_cmd(cmd)
+    output = proc_cmd(cmd, timeout=eos_timeout)
+    seen = set()
     for line in output.split():
         if len(line) > 6: # skip non-valid run and files. 
             continue
@@ -57,7 +79,8 @@ def get_runs(eos_mounted=True):
 
         run = int(run) 
 
-        if run not in runs:
+        if run not in seen:
+            seen.add(run)
             runs.append(run)
 
     return runs
@@ -114,32 +137,26 @@ def get_datfile_names(run, eos_mounted=False):
     # sys.stdout.write('getting dat files\n')
     # sys.stdout.flush()
 
+    # names, sizes and transfer markers all come from one listing
+    entries = list_run_dir(run, eos_mounted)
+    #sys.stdout.write('getting datfiles. entries: %s' % entries)
+    #sys.stdout.flush()
+    return select_datfiles(entries)
+
+def select_datfiles(entries):
+    # the largest transferred .dat file of each board, from a listing as
+    # returned by list_run_dir
     datfiles = []
     datsize = {}
     maxsize = {'PixelTestBoard1':0, 'PixelTestBoard2':0}
-    cmd = 'ls -1 %s/%s' % (daqdir, run)
-    if not eos_mounted:
-        cmd = '%s ls -1 %s/%s' % (eos, daqdir, run)
-    output = proc_cmd(cmd)
-    #sys.stdout.write('getting datfiles. output: %s' % output)
-    #sys.stdout.flush()
     
     keyword = '.dat'
-    for line in output.split():
-        if keyword in line:
+    for line, filesize in entries.items():
+        if keyword in line and not line.startswith('.'):
             #check if transfer marker exists
-            t = os.path.join(daqdir, str(run), tprefix+line)
-            if eos_mounted:
-                if not os.path.exists(t):
-                    continue
-            else:
-                cmd = '%s ls -a %s' % (eos, t)
-                stdout, rc = proc_cmd(cmd, get_returncode=True)
-                if rc != 0:
-                    continue
+            if tprefix+line not in entries:
+                continue
             #check file before adding i
-            f = os.path.join(daqdir, str(run), line)
-            filesize = get_filesize(f,eos_mounted) 
             if filesize > 10: 
                 # sys.stdout.write('%s : %d\n' % (line, filesize))
                 # sys.stdout.flush()
@@ -163,6 +180,113 @@ def get_datfile_names(run, eos_mounted=False):
 
     return datfiles
 
+def list_run_dir(run, eos_mounted=False):
+    # one long listing of the run directory, including hidden files such
+    # as the transfer markers. Returns a dict of file name to size.
+    d = os.path.join(daqdir, str(run))
+    cmd = 'ls -la %s' % d
+    if not eos_mounted:
+        cmd = '%s ls -la %s' % (eos, d)
+    output = proc_cmd(cmd, timeout=eos_timeout)
+    return parse_long_listing(output)
+
+def parse_long_listing(output):
+    # file name to size of an 'ls -l' listing
+    entries = {}
+    for line in output.splitlines():
+        item = parse_long_line(line)
+        if item is None or item[0] in ['.', '..']:
+            continue
+        entries[item[0]] = item[1]
+    return entries
+
+def parse_long_line(line):
+    # 'ls -l' lines: permissions, links, owner, group, size, date (3
+    # fields) and name. Returns name, size and date, None for other
+    # lines, such as 'total'.
+    items = line.split(None, 8)
+    if len(items) < 9 or not items[4].isdigit():
+        return None
+    return items[8], int(items[4]), ' '.join(items[5:8])
+
+def load_catalog(filename=catalog_file):
+    # catalog of the run directories listed so far, see update_catalog
+    try:
+        f = open(filename, 'rb')
+    except IOError:
+        return {'high_water': 0, 'runs': {}}
+    try:
+        return cPickle.load(f)
+    except Exception:
+        # a damaged catalog is rebuilt from the listings
+        log.warning('Could not read run catalog %s, starting a new one', filename)
+        return {'high_water': 0, 'runs': {}}
+    finally:
+        f.close()
+
+def save_catalog(catalog, filename=catalog_file):
+    # several loops save the catalog, each through a temporary file of
+    # its own, so that the rename replaces it in one go
+    tmpname = '%s.%d.tmp' % (filename, os.getpid())
+    f = open(tmpname, 'wb')
+    cPickle.dump(catalog, f, cPickle.HIGHEST_PROTOCOL)
+    f.close()
+    os.rename(tmpname, filename)
+
+def update_catalog(catalog, runs, eos_mounted=False, begin_run=0):
+    # list the directories of the runs from begin_run on that are new
+    # (above the high-water mark of the catalog) or not frozen yet. Runs
+    # below the newest one whose .dat files are all transferred and
+    # published are frozen and not listed any more.
+    if runs:
+        catalog['high_water'] = max(catalog['high_water'], max(runs))
+    for run in runs:
+        if run < begin_run:
+            continue
+        entry = catalog['runs'].get(run)
+        if entry is not None and entry['frozen']:
+            continue
+        list_catalog_run(catalog, run, eos_mounted)
+    log.debug('Catalog has %s runs, high-water mark %s',
+              len(catalog['runs']), catalog['high_water'])
+
+def relist_runs(catalog, runs, eos_mounted=False):
+    # list the directories of runs known to have changed (e.g. from the
+    # events of a watch.RunWatcher), frozen or not
+    if runs:
+        catalog['high_water'] = max(catalog['high_water'], max(runs))
+    for run in runs:
+        list_catalog_run(catalog, run, eos_mounted)
+
+def list_catalog_run(catalog, run, eos_mounted=False):
+    entries = list_run_dir(run, eos_mounted)
+    catalog['runs'][run] = {'entries': entries,
+                            'frozen': run < catalog['high_water'] and
+                                      is_run_complete(entries)}
+
+def catalog_datfile_names(catalog, run):
+    # get_datfile_names from the catalog
+    entry = catalog['runs'].get(run)
+    if entry is None:
+        return []
+    return select_datfiles(entry['entries'])
+
+def is_run_complete(entries):
+    # all .dat files of a run are transferred and all jobs are published
+    # for the selected ones
+    dats = [name for name in entries
+            if '.dat' in name and not name.startswith('.')]
+    if not dats:
+        return False
+    for dat in dats:
+        if tprefix+dat not in entries:
+            return False
+    for dat in select_datfiles(entries):
+        for job in range(JOBS.nJobs):
+            if get_job_status(job, dat) != STATUS.published:
+                return False
+    return True
+
 def cp_dat(dat, copyto_dir):
     if not os.path.exists(copyto_dir):
         os.makedirs(copyto_dir)
@@ -171,43 +295,300 @@ def cp_dat(dat, copyto_dir):
     # srcfile = os.path.join(daqdir, str(run), dat)
     
     #cmd = '%s cp %s %s' %(eos, dat, copyto_dir)
-    cmd = 'xrdcp -f root://eoscms//%s %s/' % (dat, copyto_dir)
-    log.debug('%s', cmd)
-    # sys.stdout.write('%s\n' % cmd)
-    # sys.stdout.flush()
-    output, rc = proc_cmd(cmd, get_returncode=True)
-    log.debug('%s', output)
-    # sys.stdout.write('%s\n' % output)
-    # sys.stdout.flush()
-    return rc
+    result = fetch_files([(xrootd_prefix+dat,
+                           os.path.join(copyto_dir, os.path.basename(dat)))])[0]
+    if not result['ok']:
+        return 1
+    return 0
+
+def transfer_files(transfers, workers=transfer_workers, retries=transfer_retries,
+                   timeout=transfer_timeout, copy=None):
+    # copy (source, destination) pairs of files with xrdcp, remote ones
+    # given as xrootd_prefix+path. The transfers are queued and copied by
+    # up to `workers` threads. A copy counts as done when xrdcp succeeds
+    # and the destination has the size of the source, otherwise it is
+    # retried (after transfer_backoff seconds, doubling) up to `retries`
+    # times. A missing source is not retried. Returns a dict per transfer
+    # in the order given: source, destination, ok, error, attempts, bytes,
+    # seconds of the last copy, latency (seconds from queueing to the end),
+    # MB/s and stat (url_stat of the copy, None if it failed). Each transfer is done by copy(source, destination, retries,
+    # timeout), transfer_file by default.
+    if copy is None:
+        copy = transfer_file
+    queue = Queue.Queue()
+    results = [None] * len(transfers)
+    queued = time.time()
+    for i, transfer in enumerate(transfers):
+        queue.put((i, transfer))
+    def work():
+        while True:
+            try:
+                i, (source, destination) = queue.get_nowait()
+            except Queue.Empty:
+                return
+            result = copy(source, destination, retries, timeout)
+            result['latency'] = time.time() - queued
+            results[i] = result
+    threads = [threading.Thread(target=work) for i in range(min(workers, len(transfers)))]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    for result in results:
+        if result['ok']:
+            log.debug('Copied %s: %d bytes in %.1f s (%.1f MB/s, %d attempts)',
+                      result['destination'], result['bytes'], result['seconds'],
+                      result['mb_per_sec'], result['attempts'])
+        else:
+            log.error('Failed to copy %s to %s: %s', result['source'],
+                      result['destination'], result['error'])
+    return results
+
+def transfer_file(source, destination, retries=transfer_retries, timeout=transfer_timeout,
+                  stat=None):
+    # stat is the url_stat of the source if the caller has it already
+    result = {'source': source, 'destination': destination, 'ok': False,
+              'error': None, 'attempts': 0, 'bytes': 0, 'seconds': 0.,
+              'mb_per_sec': 0., 'stat': None}
+    if stat is None:
+        size = url_size(source)
+    else:
+        size = stat[0]
+    if size is None:
+        result['error'] = 'source not found'
+        return result
+    result['bytes'] = size
+    backoff = transfer_backoff
+    while True:
+        result['attempts'] += 1
+        start = time.time()
+        try:
+            output, rc = run_cmd('xrdcp -f %s %s' % (source, destination), timeout=timeout)
+        except OSError as e:
+            rc = e
+        result['seconds'] = time.time() - start
+        copied = None
+        if rc != 0:
+            result['error'] = 'xrdcp returned %s' % rc
+        else:
+            copied = url_stat(destination)
+        if copied is None or copied[0] != size:
+            if rc == 0:
+                result['error'] = 'size of the copy is not %d bytes' % size
+        else:
+            result['ok'] = True
+            result['stat'] = copied
+            result['error'] = None
+            result['mb_per_sec'] = size / max(result['seconds'], 1e-6) / 1e6
+            return result
+        if result['attempts'] > retries:
+            return result
+        log.warning('Copy of %s failed (%s), retrying in %s s', source,
+                    result['error'], backoff)
+        time.sleep(backoff)
+        backoff *= 2
+
+def url_size(url):
+    # size of a local file or of a file on eos given as xrootd_prefix+path,
+    # None if it does not exist
+    stat = url_stat(url)
+    if stat is None:
+        return None
+    return stat[0]
+
+def url_stat(url):
+    # size and modification time of a file as for url_size
+    if not url.startswith(xrootd_prefix):
+        if not os.path.isfile(url):
+            return None
+        return os.path.getsize(url), str(os.path.getmtime(url))
+    path = '/' + url[len(xrootd_prefix):].lstrip('/')
+    try:
+        output, rc = run_cmd('%s ls -l %s' % (eos, path), timeout=eos_timeout)
+    except OSError:
+        return None
+    items = [parse_long_line(line) for line in output.splitlines()]
+    items = [item for item in items if item is not None]
+    if rc != 0 or len(items) != 1:
+        return None
+    return items[0][1], items[0][2]
+
+def fetch_files(transfers):
+    # transfer_files for copies from eos, through the node-local cache:
+    # files are kept in cache_dir under their eos path, size and
+    # modification time, and handed out as hard links (symbolic links
+    # across file systems). Only files not in the cache are copied. The
+    # results have 'cached' set for files taken from the cache.
+    if transfers and not os.path.isdir(cache_dir):
+        os.makedirs(cache_dir)
+    results = transfer_files(transfers, copy=fetch_file)
+    evict_cache()
+    return results
+
+def fetch_file(source, destination, retries=transfer_retries, timeout=transfer_timeout):
+    # one transfer of fetch_files, run by the transfer_files workers so
+    # that the eos listings of the sources are parallel too
+    stat = url_stat(source)
+    if stat is None:
+        return {'source': source, 'destination': destination, 'ok': False,
+                'error': 'source not found', 'attempts': 0, 'bytes': 0,
+                'seconds': 0., 'mb_per_sec': 0., 'cached': False}
+    cached = cache_path(source, stat)
+    if os.path.isfile(cached) and os.path.getsize(cached) == stat[0]:
+        result = {'source': source, 'destination': destination, 'ok': True,
+                  'error': None, 'attempts': 0, 'bytes': stat[0],
+                  'seconds': 0., 'mb_per_sec': 0., 'stat': url_stat(cached),
+                  'cached': True}
+        log.debug('Taking %s from the cache', source)
+    else:
+        # copy under a name of its own, so that other jobs on the node
+        # never see a partial file in the cache
+        tmpname = '%s.%d.%d.tmp' % (cached, os.getpid(), threading.current_thread().ident)
+        result = transfer_file(source, tmpname, retries, timeout, stat)
+        if result['ok']:
+            os.rename(tmpname, cached)
+        elif os.path.exists(tmpname):
+            os.remove(tmpname)
+        result['destination'] = destination
+        result['cached'] = False
+    if result['ok']:
+        try:
+            link_file(cached, destination)
+            os.utime(cached, None)
+        except OSError as e:
+            result['ok'] = False
+            result['error'] = 'could not link %s: %s' % (cached, e)
+    return result
+
+def cache_files(results):
+    # put the sources of successful uploads (results of transfer_files)
+    # into the cache, so that later fetches of them are local
+    for result in results:
+        stat = result['stat']
+        if not result['ok'] or stat is None:
+            continue
+        if not os.path.isdir(cache_dir):
+            os.makedirs(cache_dir)
+        cached = cache_path(result['destination'], stat)
+        link_file(result['source'], cached)
+        os.utime(cached, None)
+    evict_cache()
+
+def cache_path(url, stat):
+    key = '%s %s %s' % (url[len(xrootd_prefix):].lstrip('/'), stat[0], stat[1])
+    return os.path.join(cache_dir, hashlib.sha1(key).hexdigest())
+
+def link_file(source, destination):
+    if os.path.lexists(destination):
+        os.remove(destination)
+    try:
+        os.link(source, destination)
+    except OSError:
+        os.symlink(os.path.abspath(source), destination)
+
+def evict_cache(budget=cache_budget):
+    # remove the least recently used files of the cache beyond budget bytes
+    try:
+        names = os.listdir(cache_dir)
+    except OSError:
+        return
+    files = []
+    for name in names:
+        path = os.path.join(cache_dir, name)
+        try:
+            stat = os.stat(path)
+        except OSError:
+            continue
+        files.append((stat.st_mtime, stat.st_size, path))
+    total = sum(size for mtime, size, path in files)
+    for mtime, size, path in sorted(files):
+        if total <= budget:
+            break
+        try:
+            os.remove(path)
+        except OSError:
+            continue
+        total -= size
 
 
 #
 # Functions that should be fairly generic
 #
 
-def proc_cmd(cmd, test=False, verbose=1, procdir=None, env=os.environ, get_returncode=False):
+def proc_cmd(cmd, test=False, verbose=1, procdir=None, env=os.environ, get_returncode=False,
+             timeout=None):
     if test:
         sys.stdout.write(cmd+'\n')
         return 
 
-    cwd = os.getcwd()
-    if procdir != None:
-        os.chdir(procdir)
-
-    process = subprocess.Popen(cmd.split(), stdout=subprocess.PIPE, env=env)
-    process.wait()
-    stdout = process.communicate()[0]
-    rc = process.returncode
+    stdout, rc = run_cmd(cmd, cwd=procdir, env=env, timeout=timeout)
     if 'error' in stdout:
         log.error(stdout)
         #sys.stdout.write(stdout)
-    if procdir != None:
-        os.chdir(cwd)
     if get_returncode:
         return stdout, rc
     return stdout
 
+def run_cmd(cmd, cwd=None, env=None, timeout=None):
+    # run a command (split at whitespace, no shell) in directory cwd. At
+    # most max_cmds commands run at once, the others wait for a slot. The
+    # output is read while the command runs, so it never blocks on a full
+    # pipe, and only its first max_output bytes are kept. A command still
+    # running after timeout seconds is killed, together with the processes
+    # it started (it runs in a session of its own). Returns the output and
+    # the return code, which is None for a command that timed out. Safe to
+    # call from several threads.
+    cmd_slots.acquire()
+    try:
+        process = subprocess.Popen(cmd.split(), stdout=subprocess.PIPE, cwd=cwd, env=env,
+                                   preexec_fn=os.setsid)
+        chunks = []
+        reader = threading.Thread(target=read_output, args=(process.stdout, chunks))
+        reader.daemon = True
+        reader.start()
+        reader.join(timeout)
+        timed_out = reader.is_alive()
+        if timed_out:
+            log.error('Killing command after %s s: %s', timeout, cmd)
+            try:
+                os.killpg(process.pid, signal.SIGKILL)
+            except OSError:
+                pass
+            # a process that left the session could still hold the pipe
+            reader.join(kill_grace)
+        process.wait()
+    finally:
+        cmd_slots.release()
+    rc = process.returncode
+    if timed_out:
+        rc = None
+    return ''.join(list(chunks)), rc
+
+def run_cmds(cmds, cwd=None, env=None, timeout=None):
+    # run_cmd for several commands in parallel (up to max_cmds at once),
+    # returns their outputs and return codes in the order of cmds
+    results = [None] * len(cmds)
+    def run(i):
+        results[i] = run_cmd(cmds[i], cwd, env, timeout)
+    threads = [threading.Thread(target=run, args=(i,)) for i in range(len(cmds))]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    return results
+
+def read_output(pipe, chunks):
+    # read a pipe to its end, keeping the first max_output bytes
+    kept = 0
+    while True:
+        chunk = pipe.read(65536)
+        if not chunk:
+            break
+        if kept < max_output:
+            chunks.append(chunk[:max_output - kept])
+            kept += len(chunks[-1])
+    pipe.close()
+
 def get_filesize(f, eos_mounted=True):
     cmd = 'ls -l %s' % f
     if not eos_mounted:
@@ -227,7 +608,112 @@ def get_filesize(f, eos_mounted=True):
     size = int(size)
     return size 
 
-def source_bash(f):
+# environments of source_bash by file name: stamp of the sourced files and env
+env_cache = {}
+
+def source_bash(f, refresh=False):
+    # environment after sourcing f. Environments are cached in memory and
+    # in env_cache_dir, and used again as long as the modification times
+    # of f and of the files it sources are unchanged (see env_stamp).
+    # refresh forces sourcing f again.
+    stamp = env_stamp(f)
+    if not refresh:
+        cached = env_cache.get(f)
+        if cached is None:
+            cached = load_env(f)
+        if cached is not None and cached[0] == stamp:
+            env_cache[f] = cached
+            return dict(cached[1])
+    env = read_env(f)
+    env_cache[f] = (stamp, env)
+    save_env(f, stamp, env)
+    return dict(env)
+
+def clear_env_cache(f=None):
+    # forget the cached environment of f, or all of them
+    if f is None:
+        env_cache.clear()
+        try:
+            for name in os.listdir(env_cache_dir):
+                os.remove(os.path.join(env_cache_dir, name))
+        except OSError:
+            pass
+        return
+    env_cache.pop(f, None)
+    try:
+        os.remove(env_cache_name(f))
+    except OSError:
+        pass
+
+def env_stamp(f, depth=5):
+    # modification times of f and of the files it sources ('source x' or
+    # '. x'), followed up to depth levels. Files given through variables
+    # cannot be followed.
+    stamp = []
+    files = [os.path.abspath(f)]
+    for level in range(depth):
+        sourced = []
+        for name in sorted(set(files)):
+            try:
+                stamp.append((name, os.path.getmtime(name)))
+                lines = open(name).readlines()
+            except (IOError, OSError):
+                stamp.append((name, None))
+                continue
+            for line in lines:
+                for match in re.finditer(r'(?:^|[;&|(])\s*(?:source|\.)\s+([^\s;&|()$`]+)', line):
+                    # relative names are taken by the shell from the
+                    # working directory, but are usually meant relative
+                    # to the sourcing file; both are watched
+                    sourced.append(os.path.abspath(match.group(1)))
+                    sourced.append(os.path.join(os.path.dirname(name), match.group(1)))
+        files = sourced
+    return tuple(stamp)
+
+def env_cache_name(f):
+    return os.path.join(env_cache_dir, hashlib.sha1(os.path.abspath(f)).hexdigest() + '.pkl')
+
+def load_env(f):
+    # only from a directory nobody else can write to, as unpickling runs
+    # code given in the pickle
+    if not is_private_dir(env_cache_dir):
+        return None
+    try:
+        cachefile = open(env_cache_name(f), 'rb')
+    except IOError:
+        return None
+    try:
+        return cPickle.load(cachefile)
+    except Exception:
+        return None
+    finally:
+        cachefile.close()
+
+def save_env(f, stamp, env):
+    filename = env_cache_name(f)
+    try:
+        if not os.path.isdir(env_cache_dir):
+            os.makedirs(env_cache_dir, 0o700)
+        if not is_private_dir(env_cache_dir):
+            log.warning('Not caching environments in %s, which is not private', env_cache_dir)
+            return
+        tmpname = '%s.%d.tmp' % (filename, os.getpid())
+        cachefile = open(tmpname, 'wb')
+        cPickle.dump((stamp, env), cachefile, cPickle.HIGHEST_PROTOCOL)
+        cachefile.close()
+        os.rename(tmpname, filename)
+    except (IOError, OSError):
+        log.warning('Could not write environment cache %s', filename)
+
+def is_private_dir(path):
+    # a directory (not a link) of the current user, which nobody else
+    # can write to
+    if os.path.islink(path) or not os.path.isdir(path):
+        return False
+    info = os.lstat(path)
+    return info.st_uid == os.getuid() and not info.st_mode & 0o022
+
+def read_env(f):
     pipe = subprocess.Popen(". %s; env" % f, stdout=subprocess.PIPE, shell=True)
     output = pipe.communicate()[0]
     env = {}
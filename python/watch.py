@@ -0,0 +1,217 @@
+#!/usr/bin/env python
+"""
+Watch the data directory (mounted EOS or a local file system) for new
+runs, .dat files and transfer markers, and the job status directories
+of the db for new statuses
+
+"""
+
+import os
+import time
+from collections import namedtuple
+
+try:
+    import pyinotify
+except ImportError:
+    pyinotify = None
+
+import logging
+log = logging.getLogger(__name__)
+
+from config import *
+import utils
+
+# kind is 'run' for a new run directory, 'dat' for a new .dat file,
+# 'transferred' for a new transfer marker (name is the .dat file) and
+# 'status' for a new job status file of the db (name is the db file)
+WatchEvent = namedtuple('WatchEvent', ['kind', 'run', 'name'])
+
+
+def run_number(name):
+    # run number of a run directory name, None for other names
+    if len(name) > 6 or not name.isdigit():
+        return None
+    return int(name)
+
+
+def classify(run, name):
+    # event for a new entry of a run directory, None if it is of no interest
+    if name.startswith(tprefix):
+        return WatchEvent('transferred', run, name[len(tprefix):])
+    if '.dat' in name and not name.startswith('.'):
+        return WatchEvent('dat', run, name)
+    return None
+
+
+def db_run(name):
+    # run number of a db file name (<dat file>.<job>.<status>), None if
+    # it has none
+    try:
+        return int(utils.parse_datfilename(name.partition('.dat.')[0])[0])
+    except (IndexError, ValueError):
+        return None
+
+
+class RunWatcher:
+    # watches the data directory and the directories of its newest nruns
+    # runs. Uses inotify if pyinotify is available (and use_inotify is
+    # set), otherwise polls the modification times of the directories,
+    # listing only those that changed. Polling starts every min_interval
+    # seconds and slows down to max_interval while nothing changes.
+    # inotify only sees changes made through the local kernel, so it is
+    # of no use on network or FUSE mounts such as EOS, where the files
+    # are written by other hosts.
+    # Entries present at the start give no events. With a dbdir, the job
+    # status directories in it are polled as well (also with inotify, as
+    # they may only be created later on).
+
+    def __init__(self, topdir, nruns=10, min_interval=0.1, max_interval=1.0,
+                 use_inotify=True, dbdir=None):
+        self.topdir = topdir
+        self.statusdirs = []
+        if dbdir is not None:
+            self.statusdirs = [os.path.join(dbdir, JOBS.prefix[job], STATUS.prefix[status])
+                               for job in range(JOBS.nJobs)
+                               for status in range(STATUS.nStatus)]
+        self.nruns = nruns
+        self.min_interval = min_interval
+        self.max_interval = max_interval
+        self.mtimes = {}
+        self.entries = {}
+        self.runs = set()
+        self.watching = {}
+        self.statusfiles = {}
+        self.pending = []
+        self.notifier = None
+        if use_inotify and pyinotify is not None:
+            self.start_inotify()
+        self.scan()
+        self.pending = []
+
+    def wait(self, timeout=None):
+        # events since the last call, waiting up to timeout seconds (for
+        # ever if None) for the first one
+        start = time.time()
+        interval = self.min_interval
+        while True:
+            if self.notifier is not None:
+                remaining = None
+                if timeout is not None:
+                    remaining = max(timeout - (time.time() - start), 0)
+                if self.statusdirs and (remaining is None or remaining > self.max_interval):
+                    remaining = self.max_interval
+                if self.notifier.check_events(None if remaining is None else
+                                              int(remaining * 1000)):
+                    self.notifier.read_events()
+                    self.notifier.process_events()
+                self.scan_status()
+            else:
+                self.scan()
+            if self.pending or (timeout is not None and time.time() - start >= timeout):
+                events = self.pending
+                self.pending = []
+                return events
+            if self.notifier is None:
+                if timeout is not None:
+                    interval = min(interval, timeout - (time.time() - start))
+                time.sleep(max(interval, 0))
+                interval = min(2 * interval, self.max_interval)
+
+    def watched_runs(self):
+        return sorted(self.runs)[-self.nruns:]
+
+    def scan(self):
+        # poll: list the directories whose modification time changed
+        if self.changed(self.topdir):
+            for name in self.list_dir(self.topdir):
+                run = run_number(name)
+                if run is not None and run not in self.runs:
+                    self.runs.add(run)
+                    self.pending.append(WatchEvent('run', run, None))
+            self.update_watches()
+        for run in self.watched_runs():
+            rundir = os.path.join(self.topdir, str(run))
+            if self.notifier is None and self.changed(rundir):
+                self.update_run(run, self.list_dir(rundir))
+        self.scan_status()
+
+    def scan_status(self):
+        # poll the job status directories. Status files can be removed (to
+        # resubmit a job), so a file that comes back gives a new event.
+        for path in self.statusdirs:
+            if not self.changed(path):
+                continue
+            names = set(self.list_dir(path))
+            for name in names - self.statusfiles.get(path, set()):
+                self.pending.append(WatchEvent('status', db_run(name), name))
+            self.statusfiles[path] = names
+
+    def changed(self, path):
+        # directory modification times may be coarse, so a directory that
+        # changed very recently is listed again at the next poll
+        try:
+            mtime = os.stat(path).st_mtime
+        except OSError:
+            return False
+        last = self.mtimes.get(path)
+        self.mtimes[path] = mtime
+        return last is None or mtime != last or time.time() - mtime < 2
+
+    def list_dir(self, path):
+        try:
+            return os.listdir(path)
+        except OSError:
+            return []
+
+    def update_run(self, run, names):
+        entries = self.entries.setdefault(run, set())
+        for name in names:
+            if name in entries:
+                continue
+            entries.add(name)
+            event = classify(run, name)
+            if event is not None:
+                self.pending.append(event)
+
+    def start_inotify(self):
+        watcher = self
+
+        class Handler(pyinotify.ProcessEvent):
+            def process_default(self, event):
+                watcher.inotify_event(event)
+
+        self.manager = pyinotify.WatchManager()
+        self.notifier = pyinotify.Notifier(self.manager, Handler())
+        self.mask = pyinotify.IN_CREATE | pyinotify.IN_MOVED_TO
+        self.manager.add_watch(self.topdir, self.mask)
+
+    def inotify_event(self, event):
+        if os.path.dirname(event.pathname) == os.path.normpath(self.topdir):
+            run = run_number(event.name)
+            if run is not None and run not in self.runs:
+                self.runs.add(run)
+                self.pending.append(WatchEvent('run', run, None))
+                self.update_watches()
+            return
+        try:
+            run = int(os.path.basename(os.path.dirname(event.pathname)))
+        except ValueError:
+            return
+        self.update_run(run, [event.name])
+
+    def update_watches(self):
+        # with inotify: watch the directories of the newest runs, taking
+        # the entries they already have, and drop the watches of the others
+        if self.notifier is None:
+            return
+        watched = self.watched_runs()
+        for run in self.watching.keys():
+            if run not in watched:
+                self.manager.rm_watch(self.watching.pop(run))
+        for run in watched:
+            if run in self.watching:
+                continue
+            rundir = os.path.join(self.topdir, str(run))
+            descriptors = self.manager.add_watch(rundir, self.mask)
+            self.watching[run] = descriptors.get(rundir)
+            self.update_run(run, self.list_dir(rundir))